@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+# Benchmark of memory used by LRS core records: resident memory of 1M 
+# LrsPoint, LrsLine (10 vertices), LrsMilestone, LrsOrigin and LrsRecord.
+# Each kind is measured in a separate process. Run by python from QGIS 
+# installation (qgis.core must be importable) on Linux:
+#   python benchmark/geometry.py [ lrs plugin directory ]
+# To compare with older version, run it also with plugin directory of its
+# checkout, e.g. created by 'git worktree add /tmp/lrs-old <commit>':
+#   python benchmark/geometry.py /tmp/lrs-old/lrs
+import os, sys, gc, subprocess
+
+N = 1000000
+KINDS = [ 'point', 'line', 'milestone', 'origin', 'record' ]
+
+# resident memory in kB
+def rss():
+    return int( open( '/proc/self/status' ).read().split( 'VmRSS:' )[1].split()[0] )
+
+def measure( kind ):
+    from qgis.core import QgsPoint, QgsGeometry
+    from point import LrsPoint
+    from line import LrsLine
+    from milestone import LrsMilestone
+    from error import LrsOrigin
+    from part import LrsRecord
+
+    pointGeos = [ QgsGeometry.fromPoint( QgsPoint( i * 0.5, i * 0.25 ) ) for i in range(1000) ]
+    lineGeos = [ QgsGeometry.fromPolyline( [ QgsPoint( i + j, j * 0.5 ) for j in range(10) ] ) for i in range(1000) ]
+    gc.collect()
+    start = rss()
+    if kind == 'point':
+        objs = [ LrsPoint( i, 'r%d' % ( i % 1000 ), float( i ), pointGeos[ i % 1000 ] ) for i in range(N) ]
+    elif kind == 'line':
+        objs = [ LrsLine( i, 'r%d' % ( i % 1000 ), lineGeos[ i % 1000 ] ) for i in range(N) ]
+    elif kind == 'milestone':
+        objs = [ LrsMilestone( i, -1, -1, QgsPoint( i, i ), float( i ) ) for i in range(N) ]
+    elif kind == 'origin':
+        objs = [ LrsOrigin( 1, i, -1, -1 ) for i in range(N) ]
+    elif kind == 'record':
+        objs = [ LrsRecord( float( i ), i + 1.0, float( i ), i + 1.0 ) for i in range(N) ]
+    gc.collect()
+    return ( rss() - start ) / 1024.0
+
+if __name__ == '__main__':
+    if len( sys.argv ) > 2: # worker: lrs directory, kind
+        sys.path.insert( 0, sys.argv[1] )
+        print "%.0f" % measure( sys.argv[2] )
+    else:
+        lrsDir = sys.argv[1] if len( sys.argv ) > 1 else os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..', 'lrs' )
+        lrsDir = os.path.abspath( lrsDir )
+        print "%s, %d objects" % ( lrsDir, N )
+        for kind in KINDS:
+            mb = subprocess.check_output( [ sys.executable, os.path.abspath( __file__ ), lrsDir, kind ] ).strip()
+            print "%-10s %6s MB" % ( kind, mb )
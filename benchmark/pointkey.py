@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Micro-benchmark of point keys used in dictionaries of graph nodes: 
+# string from coordinates hashes (pointHash used before) and pointKey tuple.
+# Run by python from QGIS installation (qgis.core must be importable):
+#   python benchmark/pointkey.py
+import os, sys, random, timeit
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..', 'lrs' ) )
+
+from qgis.core import QgsPoint
+from utils import pointKey
+
+N = 100000
+REPEAT = 5
+
+def pointHash( point ):
+    return "%s-%s" % ( point.x().__hash__(), point.y().__hash__() )
+
+random.seed( 1 )
+points = [ QgsPoint( random.uniform( -1e6, 1e6 ), random.uniform( -1e6, 1e6 ) ) for i in range(N) ]
+
+def insertAndLookup( keyFunction ):
+    nodes = {}
+    for point in points:
+        nodes[ keyFunction( point ) ] = point
+    for point in points:
+        nodes[ keyFunction( point ) ]
+
+for name, keyFunction in [ ( 'pointHash', pointHash ), ( 'pointKey', pointKey ) ]:
+    seconds = min( timeit.repeat( lambda: insertAndLookup( keyFunction ), number = 1, repeat = REPEAT ) )
+    print "%-10s %.3f s" % ( name, seconds )
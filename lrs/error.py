@@ -20,6 +20,7 @@
  ***************************************************************************/
 """
 from hashlib import md5
+from functools import partial
 
 # Import the PyQt and QGIS libraries
 from PyQt4.QtCore import *
@@ -34,6 +35,8 @@ from utils import *
 # The identification by origin unfortunately fails if geometry part is deleted and thus
 # geoPart numbers are changed. That is why there is also nGeoParts
 class LrsOrigin(object):
+    __slots__ = ( 'geoType', 'fid', 'geoPart', 'nGeoParts' )
+
     def __init__(self, geoType, fid, geoPart = -1, nGeoParts = -1 ):
         self.geoType = geoType # QGis.Point or QGis.Line
         self.fid = fid
@@ -46,8 +49,15 @@ class LrsOrigin(object):
         m = md5( s )
         return m.digest()
 
-# Class representing error in LRS 
-class LrsError(QObject):
+    # plain data to transfer origin between processes
+    def getState(self):
+        return ( self.geoType, self.fid, self.geoPart, self.nGeoParts )
+
+# Class representing error in LRS, there may be many errors, so the class 
+# is kept small, geometry may be given as function (e.g. functools.partial) 
+# creating QgsGeometry when it is requested (highlighted, exported)
+class LrsError(object):
+    __slots__ = ( 'type', 'geo_', 'message', 'routeId', 'measure', 'origins', 'originChecksum_', 'checksum_' )
 
     # Error type enums
     DUPLICATE_LINE = 1
@@ -64,10 +74,27 @@ class LrsError(QObject):
     PARALLEL = 12 # parallel line
     FORK_LINE = 13 # parts connected in fork
 
+    # labels are translated in typeLabel()
+    typeLabels = {
+        DUPLICATE_LINE: QT_TRANSLATE_NOOP( 'LrsError', 'Duplicate line' ),
+        DUPLICATE_POINT: QT_TRANSLATE_NOOP( 'LrsError', 'Duplicate point' ),
+        FORK: QT_TRANSLATE_NOOP( 'LrsError', 'Fork' ),
+        ORPHAN: QT_TRANSLATE_NOOP( 'LrsError', 'Orphan point' ),
+        OUTSIDE_THRESHOLD: QT_TRANSLATE_NOOP( 'LrsError', 'Out of threshold' ),
+        NOT_ENOUGH_MILESTONES: QT_TRANSLATE_NOOP( 'LrsError', 'Not enough points' ),
+        NO_ROUTE_ID: QT_TRANSLATE_NOOP( 'LrsError', 'Missing route id' ),
+        NO_MEASURE: QT_TRANSLATE_NOOP( 'LrsError', 'Missing measure' ),
+        DIRECTION_GUESS: QT_TRANSLATE_NOOP( 'LrsError', 'Cannot guess direction' ),
+        WRONG_MEASURE: QT_TRANSLATE_NOOP( 'LrsError', 'Wrong measure' ),
+        DUPLICATE_REFERENCING: QT_TRANSLATE_NOOP( 'LrsError', 'Duplicate referencing' ),
+        PARALLEL: QT_TRANSLATE_NOOP( 'LrsError', 'Parallel line' ),
+        FORK_LINE: QT_TRANSLATE_NOOP( 'LrsError', 'Fork line' ),
+    }
+
+    # geo is QgsGeometry, which must not be modified later, or function returning QgsGeometry
     def __init__(self, type, geo, **kwargs ):
-        super(LrsError, self).__init__()
         self.type = type
-        self.geo = QgsGeometry(geo) # store copy of QgsGeometry
+        self.geo_ = geo
         self.message = kwargs.get('message', '')
         self.routeId = kwargs.get('routeId', None)
         self.measure = kwargs.get('measure', None) # may be list !
@@ -82,28 +109,35 @@ class LrsError(QObject):
         self.checksum_ = None
         #self.fullChecksum_ = None
 
-        # initialized here to allow stranslation, how to translate static variables?
-        self.typeLabels = {
-            self.DUPLICATE_LINE: self.tr('Duplicate line'),
-            self.DUPLICATE_POINT: self.tr('Duplicate point'),
-            self.FORK: self.tr('Fork'),
-            self.ORPHAN: self.tr('Orphan point'),
-            self.OUTSIDE_THRESHOLD: self.tr('Out of threshold'),
-            self.NOT_ENOUGH_MILESTONES: self.tr('Not enough points'),
-            self.NO_ROUTE_ID: self.tr('Missing route id'),
-            self.NO_MEASURE: self.tr('Missing measure'),
-            self.DIRECTION_GUESS: self.tr('Cannot guess direction'),
-            self.WRONG_MEASURE: self.tr('Wrong measure'),
-            self.DUPLICATE_REFERENCING: self.tr('Duplicate referencing'),
-            self.PARALLEL: self.tr('Parallel line'),
-            self.FORK_LINE: self.tr('Fork line'),
-        }
-
+    # geometry created from function is not cached to keep errors small,
+    # returned geometry must not be modified
+    @property
+    def geo(self):
+        if isinstance( self.geo_, QgsGeometry ):
+            return self.geo_
+        return self.geo_()
+
+    # plain picklable data used to transfer error from calibration worker process
+    def getState(self):
+        geo = self.geo
+        wkb = geo.asWkb() if geo else None
+        origins = [ origin.getState() for origin in self.origins ]
+        return ( self.type, wkb, self.message, self.routeId, self.measure, origins )
+
+    # create error from getState() data
+    @staticmethod
+    def fromState( state ):
+        type, wkb, message, routeId, measure, origins = state
+        geo = QgsGeometry()
+        if wkb is not None:
+            geo = partial( geometryFromWkb, wkb )
+        origins = [ LrsOrigin( *origin ) for origin in origins ]
+        return LrsError( type, geo, message = message, routeId = routeId, measure = measure, origins = origins )
 
     def typeLabel(self):
         if not self.typeLabels.has_key( self.type ):
             return "Unknown error"
-        return self.typeLabels[ self.type ]
+        return QCoreApplication.translate( 'LrsError', self.typeLabels[ self.type ] )
 
     # get string of simple value or list
     def getValueString(self, value ):
@@ -205,6 +239,10 @@ class LrsErrorModel( QAbstractTableModel ):
     def __init__(self):
         super(LrsErrorModel, self).__init__()
         self.errors = []
+        # cached index of rows, { checksum: sorted list of row ids }, see getChecksumRows()
+        self.checksumRows_ = None
+        self.removedIds_ = None # Fenwick tree of removed row ids
+        self.removedCount_ = 0
 
     def headerData( self, section, orientation, role = Qt.DisplayRole ):
         if not Qt or role != Qt.DisplayRole: return None
@@ -244,6 +282,7 @@ class LrsErrorModel( QAbstractTableModel ):
         
     def addErrors ( self, errors ):
         self.errors.extend ( errors )
+        self.checksumRows_ = None
 
     def getError (self, index):
         if not index: return None
@@ -251,26 +290,92 @@ class LrsErrorModel( QAbstractTableModel ):
         if row < 0 or row >= len(self.errors): return None
         return self.errors[row]
 
+    # The index keeps stable row ids (1 based) given to errors when they are
+    # indexed, removed ids are counted in Fenwick tree removedIds_ to convert
+    # id to current row in O(log n), i.e. row = id - 1 - removed ids before id.
+    # The index is rebuilt when more than half of ids is removed.
+    def getChecksumRows(self):
+        if self.checksumRows_ is None:
+            self.checksumRows_ = {}
+            for i in range( len(self.errors) ):
+                self.checksumRows_.setdefault( self.errors[i].getChecksum(), [] ).append( i + 1 )
+            self.removedIds_ = [ 0 ] * ( len(self.errors) + 1 )
+            self.removedCount_ = 0
+        return self.checksumRows_
+
+    # number of removed ids lower or equal to id
+    def removedIdsCount(self, id):
+        count = 0
+        while id > 0:
+            count += self.removedIds_[id]
+            id -= id & -id
+        return count
+
+    def idRow(self, id):
+        return id - 1 - self.removedIdsCount( id )
+
+    # add new id at the end of index
+    def appendChecksumId(self, checksum):
+        id = len( self.removedIds_ )
+        # node covers ids ( id - lowbit, id ], the new id is not removed
+        self.removedIds_.append( self.removedIdsCount( id - 1 ) - self.removedIdsCount( id - ( id & -id ) ) )
+        self.checksumRows_.setdefault( checksum, [] ).append( id )
+
+    def removeChecksumId(self, checksum, id):
+        ids = self.checksumRows_[checksum]
+        ids.remove( id )
+        if not ids:
+            del self.checksumRows_[checksum]
+        self.removedCount_ += 1
+        while id < len( self.removedIds_ ):
+            self.removedIds_[id] += 1
+            id += id & -id
+
     def getErrorIndexForChecksum( self, checksum ):
-        for i in range( len(self.errors) ):
-            if self.errors[i].getChecksum() == checksum:
-                return i
+        ids = self.getChecksumRows().get( checksum )
+        if ids: return self.idRow( ids[0] )
         return None # should not happen
         
-    def rowsToBeRemoved(self, errorUpdates):
-        rows = []
+    # [ checksum, id ] of removed errors, if more errors have the same checksum,
+    # the first rows are removed
+    def idsToBeRemoved(self, errorUpdates):
+        checksumRows = self.getChecksumRows()
+        used = {} # checksum: number of rows used
+        ids = []
         for checksum in errorUpdates['removedErrorChecksums']:
-            rows.append ( self.getErrorIndexForChecksum( checksum ) )
-        return rows
+            checksumIds = checksumRows.get( checksum, [] )
+            n = used.get( checksum, 0 )
+            if n < len( checksumIds ):
+                ids.append ( [ checksum, checksumIds[n] ] )
+                used[checksum] = n + 1
+        return ids
+
+    # rows of removed errors
+    def rowsToBeRemoved(self, errorUpdates):
+        return [ self.idRow( id ) for checksum, id in self.idsToBeRemoved( errorUpdates ) ]
 
     def updateErrors(self, errorUpdates):
         #debug ( 'errorUpdates: %s' % errorUpdates ) 
-        for checksum in errorUpdates['removedErrorChecksums']:
-            idx = self.getErrorIndexForChecksum( checksum )
-            #debug ( 'remove row %s' % idx )
-            self.beginRemoveRows( QModelIndex(), idx, idx )
-            del self.errors[idx]
+        removedIds = self.idsToBeRemoved( errorUpdates )
+        # remove continuous ranges of rows from the end so that rows 
+        # to be removed are not shifted
+        rows = sorted( [ self.idRow( id ) for checksum, id in removedIds ], reverse = True )
+        i = 0
+        while i < len(rows):
+            last = first = rows[i]
+            while i+1 < len(rows) and rows[i+1] == first-1:
+                i += 1
+                first -= 1
+            #debug ( 'remove rows %s - %s' % ( first, last ) )
+            self.beginRemoveRows( QModelIndex(), first, last )
+            del self.errors[first:last+1]
             self.endRemoveRows()
+            i += 1
+        for checksum, id in removedIds:
+            self.removeChecksumId( checksum, id )
+        # compact index if most of ids is removed
+        if self.removedCount_ * 2 > len( self.removedIds_ ):
+            self.checksumRows_ = None
 
         for error in errorUpdates['updatedErrors']:
             checksum = error.getChecksum() 
@@ -287,6 +392,8 @@ class LrsErrorModel( QAbstractTableModel ):
             self.beginInsertRows( QModelIndex(), idx, idx )
             self.errors.append ( error )
             self.endInsertRows()
+            if self.checksumRows_ is not None:
+                self.appendChecksumId( error.getChecksum() )
 
 
 class LrsFeature(QgsFeature):
@@ -319,10 +426,10 @@ LRS_ERROR_FIELDS = LrsErrorFields()
 
 class LrsErrorFeature(LrsFeature):
 
-    def __init__(self, error ):
+    # geo: error geometry if already created, created from error otherwise
+    def __init__(self, error, geo = None ):
         super(LrsErrorFeature, self).__init__( LRS_ERROR_FIELDS )
-        error = error
-        self.setGeometry( error.geo )
+        self.setGeometry( geo if geo is not None else error.geo )
         self.checksum = error.getChecksum()
 
         values = {
@@ -409,7 +516,7 @@ class LrsErrorVisualizer(object):
         geo = error.geo
         mapRenderer = self.mapCanvas.mapRenderer()
         if mapRenderer.hasCrsTransformEnabled() and mapRenderer.destinationCrs() != crs:
-            geo = QgsGeometry( error.geo )
+            geo = QgsGeometry( geo )
             transform = QgsCoordinateTransform( crs, mapRenderer.destinationCrs() )
             geo.transform( transform )
 
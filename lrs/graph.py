@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ LrsGraph
+                                 A QGIS plugin
+ Linear reference system builder and editor
+                              -------------------
+        begin                : 2013-10-02
+        copyright            : (C) 2013 by Radim Blažek
+        email                : radim.blazek@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+from collections import deque
+# Import the PyQt and QGIS libraries
+from PyQt4.QtCore import *
+#from PyQt4.QtGui import *
+from qgis.core import *
+
+from utils import *
+
+# Graph of polylines (edges) connected in their end points (nodes), 
+# used to find forks and to join polylines into chains
+class LrsGraph(object):
+
+    # polylines ends must be already snapped, nodes are matched exactly
+    def __init__(self, polylines):
+        self.polylines = polylines # list of QgsPolyline
+        self.nodes = {} # pointKey: node
+        self.nodesList = [] # nodes in order of creation
+        for i in range( len(polylines) ):
+            for end in [0, -1]:
+                key = pointKey( polylines[i][end] )
+                node = self.nodes.get( key )
+                if node is None:
+                    # edges: list of [ polyline index, end index (0/-1) ],
+                    # closed polyline is twice in the same node
+                    node = { 'pnt': polylines[i][end], 'edges': [] }
+                    self.nodes[key] = node
+                    self.nodesList.append( node )
+                node['edges'].append( [ i, end ] )
+
+    # returns list of [ QgsPoint, list of polyline indices ] of nodes with more than 2 edges
+    def getForks(self):
+        forks = []
+        for node in self.nodesList:
+            if len( node['edges'] ) > 2:
+                forks.append( [ node['pnt'], [ edge[0] for edge in node['edges'] ] ] )
+        return forks
+
+    # returns lists of indices of polylines connecting the same pair of nodes 
+    # (in any direction), lists are ordered by their first polyline index
+    def getParallels(self):
+        pairs = {} # sorted pair of nodes keys: list of polyline indices
+        groups = []
+        for i in range( len(self.polylines) ):
+            polyline = self.polylines[i]
+            pair = tuple( sorted( [ pointKey( polyline[0] ), pointKey( polyline[-1] ) ] ) )
+            indices = pairs.get( pair )
+            if indices is None:
+                indices = []
+                pairs[pair] = indices
+                groups.append( indices )
+            indices.append( i )
+        return [ indices for indices in groups if len( indices ) > 1 ]
+
+    # returns [ polyline index, end index ] of not used polyline which may be connected in pnt
+    # (it is the only other polyline in that node) or None
+    def nextEdge(self, pnt, used):
+        edges = self.nodes[ pointKey( pnt ) ]['edges']
+        # don't connect in forks (we don't know which is better)
+        if len( edges ) != 2: return None
+        for edge in edges:
+            if not used[ edge[0] ]:
+                return edge
+        return None
+
+    # Join polylines connected in nodes without fork into chains.
+    # Polylines are taken as seeds in original order and each chain grows from
+    # its seed by connecting first polyline (in original order) at its end or 
+    # beginning, the seed direction is kept.
+    # Returns list of [ QgsPolyline, list of polyline indices in order as connected ]
+    def getChains(self):
+        chains = []
+        used = [ False ] * len( self.polylines )
+        for seed in range( len( self.polylines ) ):
+            if used[seed]: continue
+            used[seed] = True
+            polyline = deque( self.polylines[seed] )
+            indices = [ seed ]
+            while True:
+                last = self.nextEdge( polyline[-1], used )
+                first = self.nextEdge( polyline[0], used )
+                if last is None and first is None: # no more polylines can be connected
+                    break
+
+                if last is not None and ( first is None or last[0] <= first[0] ):
+                    idx, end = last
+                    polyline2 = self.polylines[idx]
+                    if end == 0: # --1-->  --2-->
+                        polyline.extend( polyline2[1:] )
+                    else: # --1--> <--2--
+                        polyline.extend( polyline2[-2::-1] )
+                else:
+                    idx, end = first
+                    polyline2 = self.polylines[idx]
+                    if end == -1: # --2--> --1-->
+                        polyline.extendleft( polyline2[-2::-1] )
+                    else: # <--2-- --1-->
+                        polyline.extendleft( polyline2[1:] )
+
+                used[idx] = True
+                indices.append( idx )
+
+            chains.append( [ list( polyline ), indices ] )
+        return chains
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ LrsSegmentIndex
+                                 A QGIS plugin
+ Linear reference system builder and editor
+                              -------------------
+        begin                : 2013-10-02
+        copyright            : (C) 2013 by Radim Blažek
+        email                : radim.blazek@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+import bisect
+# Import the PyQt and QGIS libraries
+from PyQt4.QtCore import *
+#from PyQt4.QtGui import *
+from qgis.core import *
+
+from utils import *
+
+# epsilon used by QgsGeometry.closestSegmentWithContext() (DEFAULT_SEGMENT_EPSILON)
+SEGMENT_EPSILON = 1e-8
+
+# Spatial index of segments of polylines, used to find nearest segment
+# without testing all segments of all polylines. Polylines are identified by key,
+# if initialized from list, keys are list indices. Polylines may be inserted 
+# and deleted later, e.g. when a route is edited.
+class LrsSegmentIndex(object):
+
+    def __init__(self, polylines = None):
+        self.polylines = {} # key: QgsPolyline
+        self.spatialIndex = QgsSpatialIndex()
+        self.segments = {} # fid: [ polyline key, segment index ]
+        self.polylineFids = {} # key: list of segments fids
+        self.nextFid = 1
+        # cached numpy array of segments coordinates [[x1,y1,x2,y2],...] with spare
+        # rows, updated on insert/delete once created, rows of deleted segments
+        # are set to NaN (never within threshold) and removed by compactCoordinates()
+        self.coordinates_ = None
+        self.coordinateRows = {} # fid: row in coordinates_
+        self.coordinatesCount = 0 # number of used rows including deleted
+        self.deletedCount = 0 # number of rows of deleted segments
+        if polylines:
+            for i in range( len(polylines) ):
+                self.insert( i, polylines[i] )
+
+    def segmentFeature(self, fid, polyline, j):
+        feature = QgsFeature( fid )
+        feature.setGeometry( QgsGeometry.fromPolyline( [ polyline[j], polyline[j+1] ] ) )
+        return feature
+
+    def insert(self, key, polyline):
+        self.delete( key )
+        self.polylines[key] = polyline
+        fids = []
+        for j in range( len(polyline)-1 ):
+            fid = self.nextFid
+            self.nextFid += 1
+            self.spatialIndex.insertFeature( self.segmentFeature( fid, polyline, j ) )
+            self.segments[fid] = [ key, j ]
+            fids.append( fid )
+        self.polylineFids[key] = fids
+        if self.coordinates_ is not None:
+            self.appendCoordinates( fids )
+
+    def delete(self, key):
+        polyline = self.polylines.pop( key, None )
+        if polyline is None: return
+        # feature geometry is needed to find the segment in index
+        fids = self.polylineFids.pop( key )
+        for fid in fids:
+            j = self.segments.pop( fid )[1]
+            self.spatialIndex.deleteFeature( self.segmentFeature( fid, polyline, j ) )
+        if self.coordinates_ is not None:
+            self.deleteCoordinates( fids )
+
+    # search rectangle is slightly enlarged to get also segments in threshold 
+    # distance affected by rounding or by epsilon used in sqrDistToSegment
+    def searchRectangle(self, x, y, threshold):
+        d = threshold * 1.000001 + 0.0001
+        return QgsRectangle( x-d, y-d, x+d, y+d )
+
+    # Returns [ sqDist, polyline key, segment index, nearest point ] of nearest segment 
+    # within threshold or None. If more segments are in the same distance,
+    # the first inserted one is returned, i.e. for index initialized from list
+    # the first by polyline and segment index, like if closestSegmentWithContext 
+    # was called on each polyline in sequence.
+    def nearestSegment(self, pnt, threshold):
+        sqrThreshold = threshold * threshold
+        nearest = None
+        nearestFid = None
+        for fid in self.spatialIndex.intersects( self.searchRectangle( pnt.x(), pnt.y(), threshold ) ):
+            i, j = self.segments[fid]
+            polyline = self.polylines[i]
+            ( sqDist, nearestPnt ) = pnt.sqrDistToSegment( polyline[j].x(), polyline[j].y(), polyline[j+1].x(), polyline[j+1].y() )
+            if sqDist > sqrThreshold: continue
+            if nearest is None or [ sqDist, fid ] < [ nearest[0], nearestFid ]:
+                nearest = [ sqDist, i, j, nearestPnt ]
+                nearestFid = fid
+        return nearest
+
+    def getCoordinates(self):
+        if self.coordinates_ is None:
+            self.coordinates_ = numpy.empty( ( 0, 4 ), dtype = numpy.float64 )
+            self.coordinateRows = {}
+            self.coordinatesCount = 0
+            self.deletedCount = 0
+            self.appendCoordinates( sorted( self.segments.keys() ) )
+        return self.coordinates_
+
+    # append rows of inserted segments, the array grows by doubling
+    def appendCoordinates(self, fids):
+        count = self.coordinatesCount + len(fids)
+        if count > len( self.coordinates_ ):
+            coordinates = numpy.empty( ( max( count, 2 * len( self.coordinates_ ), 16 ), 4 ), dtype = numpy.float64 )
+            coordinates[:self.coordinatesCount] = self.coordinates_[:self.coordinatesCount]
+            self.coordinates_ = coordinates
+        row = self.coordinatesCount
+        for fid in fids:
+            i, j = self.segments[fid]
+            p1 = self.polylines[i][j]
+            p2 = self.polylines[i][j+1]
+            self.coordinates_[row] = ( p1.x(), p1.y(), p2.x(), p2.y() )
+            self.coordinateRows[fid] = row
+            row += 1
+        self.coordinatesCount = count
+
+    # mark rows of deleted segments, compact when half of rows is deleted
+    def deleteCoordinates(self, fids):
+        for fid in fids:
+            self.coordinates_[ self.coordinateRows.pop( fid ) ] = numpy.nan
+        self.deletedCount += len(fids)
+        if self.deletedCount * 2 > self.coordinatesCount:
+            self.compactCoordinates()
+
+    # remove rows of deleted segments keeping order of rows
+    def compactCoordinates(self):
+        fids = sorted( self.coordinateRows.keys(), key = lambda fid: self.coordinateRows[fid] )
+        rows = numpy.array( [ self.coordinateRows[fid] for fid in fids ], dtype = int )
+        coordinates = numpy.empty( ( max( 2 * len(fids), 16 ), 4 ), dtype = numpy.float64 )
+        coordinates[:len(fids)] = self.coordinates_[rows]
+        self.coordinates_ = coordinates
+        self.coordinateRows = dict( zip( fids, range(len(fids)) ) )
+        self.coordinatesCount = len(fids)
+        self.deletedCount = 0
+
+    # Batch version of nearestSegment for points given by coordinates xs, ys.
+    # If numpy is available, distances to all candidate segments are calculated 
+    # at once in the same way as in QgsPoint.sqrDistToSegment.
+    # Returns list of [ sqDist, polyline key, segment index, nearest point ] or None
+    def nearestSegments(self, xs, ys, threshold):
+        if not haveNumpy:
+            return [ self.nearestSegment( QgsPoint( xs[k], ys[k] ), threshold ) for k in range(len(xs)) ]
+
+        # candidate pairs of point index and segment fid
+        pointIndices = []
+        fids = []
+        for k in range(len(xs)):
+            candidates = self.spatialIndex.intersects( self.searchRectangle( xs[k], ys[k], threshold ) )
+            pointIndices.extend( [ k ] * len(candidates) )
+            fids.extend( candidates )
+
+        nearest = [ None ] * len(xs)
+        if not fids: return nearest
+
+        pointIndices = numpy.array( pointIndices )
+        fids = numpy.array( fids )
+        px = numpy.array( xs, dtype = numpy.float64 )[pointIndices]
+        py = numpy.array( ys, dtype = numpy.float64 )[pointIndices]
+        coordinates = self.getCoordinates()
+        segments = coordinates[ numpy.array( [ self.coordinateRows[fid] for fid in fids.tolist() ], dtype = int ) ]
+        x1 = segments[:,0]
+        y1 = segments[:,1]
+        x2 = segments[:,2]
+        y2 = segments[:,3]
+
+        # QgsPoint::sqrDistToSegment()
+        nx = y2 - y1
+        ny = -( x2 - x1 )
+        t = ( px * ny - py * nx - x1 * ny + y1 * nx ) / ( ( x2 - x1 ) * ny - ( y2 - y1 ) * nx )
+        mx = numpy.where( t < 0.0, x1, numpy.where( t > 1.0, x2, x1 + t * ( x2 - x1 ) ) )
+        my = numpy.where( t < 0.0, y1, numpy.where( t > 1.0, y2, y1 + t * ( y2 - y1 ) ) )
+        sqDist = ( px - mx ) * ( px - mx ) + ( py - my ) * ( py - my )
+        # prevent rounding errors if the point is directly on the segment
+        onSegment = ( sqDist > -SEGMENT_EPSILON ) & ( sqDist <= SEGMENT_EPSILON )
+        sqDist[onSegment] = 0.0
+        mx[onSegment] = px[onSegment]
+        my[onSegment] = py[onSegment]
+
+        # nearest segment for each point, the first inserted if in the same distance
+        within = numpy.nonzero( sqDist <= threshold * threshold )[0]
+        order = within[ numpy.lexsort( ( fids[within], sqDist[within], pointIndices[within] ) ) ]
+        first = numpy.ones( len(order), dtype = bool )
+        first[1:] = pointIndices[order][1:] != pointIndices[order][:-1]
+        for m in order[first].tolist():
+            i, j = self.segments[ int( fids[m] ) ]
+            nearest[ int( pointIndices[m] ) ] = [ float( sqDist[m] ), i, j, QgsPoint( float( mx[m] ), float( my[m] ) ) ]
+        return nearest
+
+# Index of route parts records by measure, used to find records for events
+# without testing all records of all parts
+class LrsMeasureIndex(object):
+
+    def __init__(self, parts):
+        self.records = [] # [ milestoneFrom, milestoneTo, part index, record index ]
+        self.ends = [] # [ measure, part index, record index, 0 for from / 1 for to ]
+        for i in range( len(parts) ):
+            records = parts[i].records
+            for j in range( len(records) ):
+                record = records[j]
+                self.records.append( [ record.milestoneFrom, record.milestoneTo, i, j ] )
+                self.ends.append( [ record.milestoneFrom, i, j, 0 ] )
+                self.ends.append( [ record.milestoneTo, i, j, 1 ] )
+        self.records.sort()
+        self.ends.sort()
+        self.froms = [ record[0] for record in self.records ]
+        self.endMeasures = [ end[0] for end in self.ends ]
+        # maximum milestoneTo of all records up to index, records before 
+        # the first record with maxTo lower than measure cannot contain measure 
+        self.maxTos = []
+        maxTo = None
+        for record in self.records:
+            if maxTo is None or record[1] > maxTo: maxTo = record[1]
+            self.maxTos.append( maxTo )
+
+    # returns sorted list of [ part index, record index ] of records whose 
+    # closed measure range intersects closed range start-end
+    def intersects(self, start, end):
+        found = []
+        i = bisect.bisect_right( self.froms, end )
+        while i > 0 and self.maxTos[i-1] >= start:
+            i -= 1
+            record = self.records[i]
+            if record[1] >= start:
+                found.append( record[2:4] )
+        found.sort()
+        return found
+
+    # returns [ measure, part index ] of record end nearest to measure within
+    # tolerance or None, if more ends have the same distance, the first
+    # by part and record index is returned, from before to
+    def nearestEnd(self, measure, tolerance):
+        # ends within tolerance form continuous range in sorted ends
+        lo = bisect.bisect_left( self.endMeasures, measure - tolerance )
+        while lo > 0 and abs( self.endMeasures[lo-1] - measure ) <= tolerance:
+            lo -= 1
+        hi = bisect.bisect_right( self.endMeasures, measure + tolerance )
+        while hi < len( self.endMeasures ) and abs( self.endMeasures[hi] - measure ) <= tolerance:
+            hi += 1
+
+        nearestKey = None
+        nearest = None
+        for end in self.ends[lo:hi]:
+            m = abs( end[0] - measure )
+            if m > tolerance: continue
+            key = [ m, end[1], end[2], end[3] ]
+            if nearestKey is None or key < nearestKey:
+                nearestKey = key
+                nearest = end[0:2]
+        return nearest
@@ -83,23 +83,48 @@ class LrsQualityLayer(QgsVectorLayer):
 # Keeps track of features by checksum.
 class LrsLayerManager(object):
 
+    # maximum number of single feature signals emitted to update attribute table,
+    # if more features were changed, the layer is notified once
+    MAX_SIGNALS = 100
+
     def __init__(self, layer ):
         super(LrsLayerManager, self).__init__()
         self.layer = layer
         self.featureIds = {} # dictionary of features with checksum keys
 
+    # hack to update attribute table, signals is list of [ signal, args ],
+    # many signals are slow, dataChanged is used instead if available 
+    # (missing in older QGIS versions), dataChanged does not repaint map
+    def emitSignals(self, signals):
+        if len( signals ) > self.MAX_SIGNALS and hasattr( self.layer, 'dataChanged' ):
+            self.layer.dataChanged.emit()
+            self.layer.triggerRepaint()
+            return
+        for signal, args in signals:
+            signal.emit( *args )
+
+    # delete all features from provider, returns deleted fids
+    def deleteAllFeatures(self):
+        request = QgsFeatureRequest().setFlags( QgsFeatureRequest.NoGeometry ).setSubsetOfAttributes( [] )
+        fids = [ feature.id() for feature in self.layer.dataProvider().getFeatures( request ) ]
+        if len (fids) > 0:
+            self.layer.dataProvider().deleteFeatures( fids )
+        self.featureIds = {}
+        return fids
+
     # remove all features
     def clear(self):
         if not self.layer: return
-        fids = []
-        for feature in self.layer.getFeatures():
-            fids.append( feature.id() )
+        fids = self.deleteAllFeatures()
+        self.emitSignals( [ [ self.layer.featureDeleted, ( fid, ) ] for fid in fids ] )
 
-        self.layer.dataProvider().deleteFeatures( fids )
-        
-        for fid in fids:
-            # hack to update attribute table
-            self.layer.featureDeleted.emit( fid )
+    # replace all features by new features, layer is notified once 
+    # instead of per feature signals if there are many features
+    def reload(self, features, crs):
+        if not self.layer: return
+        signals = [ [ self.layer.featureDeleted, ( fid, ) ] for fid in self.deleteAllFeatures() ]
+        signals.extend( [ [ self.layer.featureAdded, ( fid, ) ] for fid in self.addProviderFeatures( features, crs ) ] )
+        self.emitSignals( signals )
 
     # transform features if necessary to layer crs
     # modifies original feature geometry
@@ -110,15 +135,21 @@ class LrsLayerManager(object):
                 feature.geometry().transform( transform )
         return features 
 
-    # add features with getChecksum() method
-    def addFeatures(self, features, crs):
+    # add features with getChecksum() method to provider, returns added fids
+    def addProviderFeatures(self, features, crs):
         features = self.transformFeatures(features, crs)
  
         status, addedFeatures = self.layer.dataProvider().addFeatures( features )
+        fids = []
         for feature, addedFeature in zip(features,addedFeatures):
             self.featureIds[feature.getChecksum()] = addedFeature.id()
-            # hack to update attribute table
-            self.layer.featureAdded.emit( addedFeature.id() )
+            fids.append( addedFeature.id() )
+        return fids
+
+    # add features with getChecksum() method
+    def addFeatures(self, features, crs):
+        fids = self.addProviderFeatures( features, crs )
+        self.emitSignals( [ [ self.layer.featureAdded, ( fid, ) ] for fid in fids ] )
 
     # delete features by checksums
     def deleteChecksums(self,checksums):
@@ -131,9 +162,7 @@ class LrsLayerManager(object):
         if len (fids) > 0:
             self.layer.dataProvider().deleteFeatures( fids )
 
-        for fid in fids:
-            # hack to update attribute table
-            self.layer.featureDeleted.emit( fid )
+        self.emitSignals( [ [ self.layer.featureDeleted, ( fid, ) ] for fid in fids ] )
 
     def updateFeatures(self, features, crs):
         features = self.transformFeatures(features, crs)
@@ -149,10 +178,11 @@ class LrsLayerManager(object):
         self.layer.dataProvider().changeGeometryValues(changedGeometries)
         self.layer.dataProvider().changeAttributeValues(changedAttributes)
 
-        # hack to update attribute table
+        signals = []
         for fid, attr in changedAttributes.iteritems():
             for i, value in attr.iteritems():
-                self.layer.attributeValueChanged.emit(fid, i, value )
+                signals.append( [ self.layer.attributeValueChanged, ( fid, i, value ) ] )
+        self.emitSignals( signals )
 
 class LrsErrorLayerManager(LrsLayerManager):
 
@@ -160,23 +190,32 @@ class LrsErrorLayerManager(LrsLayerManager):
         super(LrsErrorLayerManager, self).__init__(layer)
         
     # test if error geometry type matches this layer
-    def errorTypeMatch(self, error): 
-        if self.layer.geometryType() == QGis.Point and error.geo.wkbType() != QGis.WKBPoint: return False
-        if self.layer.geometryType() == QGis.Line and error.geo.wkbType() != QGis.WKBLineString: return False
+    def errorTypeMatch(self, geo): 
+        wkbType = geo.wkbType()
+        if self.layer.geometryType() == QGis.Point and wkbType != QGis.WKBPoint: return False
+        if self.layer.geometryType() == QGis.Line and wkbType != QGis.WKBLineString: return False
         return True
 
 
-    # get errors of layer type (point or line)
-    def addErrors(self, errors, crs):
-        if not self.layer: return
-
+    # get features of errors of layer type (point or line), error geometry
+    # may be created by function, it is created only once for each error
+    def errorFeatures(self, errors):
         features = []
         for error in errors:
-            if not self.errorTypeMatch( error): continue
-            feature = LrsErrorFeature( error )
+            geo = error.geo
+            if not self.errorTypeMatch( geo ): continue
+            feature = LrsErrorFeature( error, geo )
             features.append( feature )
+        return features
 
-        self.addFeatures(features, crs)
+    def addErrors(self, errors, crs):
+        if not self.layer: return
+        self.addFeatures( self.errorFeatures( errors ), crs)
+
+    # replace all features by errors
+    def reloadErrors(self, errors, crs):
+        if not self.layer: return
+        self.reload( self.errorFeatures( errors ), crs)
 
 
 
@@ -188,12 +227,7 @@ class LrsErrorLayerManager(LrsLayerManager):
         self.deleteChecksums( errorUpdates['removedErrorChecksums'] )
 
         # update 
-        features = []
-        for error in errorUpdates['updatedErrors']:
-            if not self.errorTypeMatch( error): continue
-
-            feature = LrsErrorFeature( error )
-            features.append( feature)
+        features = self.errorFeatures( errorUpdates['updatedErrors'] )
         self.updateFeatures(features, errorUpdates['crs'])
 
         # add new
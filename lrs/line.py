@@ -26,17 +26,37 @@ from qgis.core import *
 
 from utils import *
 
+# Geometry is kept as WKB which is much smaller than QgsGeometry
 class LrsLine(object):
+    __slots__ = ( 'fid', 'routeId', 'wkb' )
 
     def __init__(self, fid, routeId, geo ):
         self.fid = fid # line
         self.routeId = routeId
-        self.geo = QgsGeometry(geo) # store copy of QgsGeometry, may be None
+        self.wkb = geo.asWkb() if geo else None # geo WKB, None if geo is None
+
+    # original feature geometry, new QgsGeometry is created on each call
+    @property
+    def geo(self):
+        if self.wkb is None: return None
+        return geometryFromWkb( self.wkb )
 
     def getNumParts(self):
-        if not self.geo: return 0
+        geo = self.geo
+        if not geo: return 0
 
-        if self.geo.isMultipart():
-            return len( self.geo.asMultiPolyline() )
+        if geo.isMultipart():
+            return len( geo.asMultiPolyline() )
 
         return 1
+
+    # returns list of polylines of all geometry parts
+    def getPolylines(self):
+        geo = self.geo
+        if not geo: return []
+
+        if geo.wkbType() in [ QGis.WKBLineString, QGis.WKBLineString25D]:
+            return [ geo.asPolyline() ]
+        elif geo.wkbType() in [ QGis.WKBMultiLineString, QGis.WKBMultiLineString25D]:
+            return geo.asMultiPolyline()
+        return []
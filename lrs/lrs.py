@@ -19,10 +19,10 @@
  *                                                                         *
  ***************************************************************************/
 """
-import time
+import time, os, multiprocessing
 # Import the PyQt and QGIS libraries
 from PyQt4.QtCore import *
-#from PyQt4.QtGui import *
+from PyQt4.QtGui import QApplication
 from qgis.core import *
 
 from utils import *
@@ -30,8 +30,21 @@ from route import LrsRoute
 from point import LrsPoint
 from line import LrsLine
 from error import *
+from index import LrsSegmentIndex
 #from line
 
+# Routes shared with forked calibration worker processes, set only while
+# the pool is running, see Lrs.calibrateRoutesParallel()
+calibrationRoutes = {}
+calibrationExtrapolate = False
+
+# calibrate single route in worker process
+# returns route key and picklable calibration results
+def calibrateRouteWorker( routeKey ):
+    route = calibrationRoutes[routeKey]
+    route.calibrate( calibrationExtrapolate )
+    return routeKey, route.getCalibrationState()
+
 # Main class to keep all data and process them
 
 class Lrs(QObject):
@@ -57,6 +70,9 @@ class Lrs(QObject):
         CALIBRATING_ROUTES: 'Calibrating routes',
     }
 
+    # delay in ms after last edit signal before edited routes are recalibrated
+    RECALIBRATE_DELAY = 100
+
     def __init__(self, lineLayer, lineRouteField, pointLayer, pointRouteField, pointMeasureField, **kwargs ):
         super(Lrs, self).__init__()
 
@@ -94,6 +110,11 @@ class Lrs(QObject):
         # extrapolate LRS before/after calibration points
         self.extrapolate = kwargs.get('extrapolate', False)
 
+        # number of worker processes used to calibrate routes, 
+        # 1 - calibrate in this process, 0 - number of CPUs,
+        # used only in headless scripts, see parallelCalibrationAvailable()
+        self.workers = kwargs.get('workers', 1)
+
         # stored line route id QgsField to know type
         self.routeField = None 
 
@@ -147,11 +168,20 @@ class Lrs(QObject):
         # dictionary of LrsRoute, key is normalized route id
         self.routes = {} 
 
-        self.partSpatialIndex = None
-        self.partSpatialIndexRoutePart = None
+        # LrsSegmentIndex of all routes parts
+        self.segmentIndex = None
+        self.segmentIndexRouteParts = None
 
         self.wasEdited = False # true if layers were edited since calibration
 
+        # routes edited since last recalibration, key is normalized route id,
+        # they are recalibrated at once after burst of edit signals
+        self.dirtyRoutes = {}
+        self.recalibrateTimer = QTimer( self )
+        self.recalibrateTimer.setSingleShot( True )
+        self.recalibrateTimer.setInterval( self.RECALIBRATE_DELAY )
+        self.recalibrateTimer.timeout.connect( self.recalibrateDirtyRoutes )
+
         QgsMapLayerRegistry.instance().layersWillBeRemoved.connect(self.layersWillBeRemoved)        
 
     def __del__(self):
@@ -219,6 +249,9 @@ class Lrs(QObject):
         self.points = {}
         self.lines = {} 
         self.errors = [] # reset
+        self.deleteSegmentIndex()
+        self.recalibrateTimer.stop()
+        self.dirtyRoutes = {}
 
         self.stats = {}
         for s in self.statsNames:
@@ -237,9 +270,7 @@ class Lrs(QObject):
 
         self.registerLines()
         self.registerPoints()
-        for route in self.routes.values():
-            route.calibrate(self.extrapolate)
-            self.progressStep(self.CALIBRATING_ROUTES) 
+        self.calibrateRoutes()
 
         # count stats
         for route in self.routes.values():
@@ -249,6 +280,49 @@ class Lrs(QObject):
         #self.stats['pointsError'] = self.stats['pointsIncluded'] - self.stats['pointsOk']
 
 
+    # Workers get routes by fork, which is not available on Windows. Forking 
+    # of process with running Qt GUI (threads, event loop) is not safe,
+    # parallel calibration is thus used only in scripts without GUI, e.g.
+    # with QgsApplication( [], False )
+    @staticmethod
+    def parallelCalibrationAvailable():
+        if not hasattr( os, 'fork' ): return False
+        app = QCoreApplication.instance()
+        if app is None: return True
+        return not isinstance( app, QApplication ) or app.type() == QApplication.Tty
+
+    def calibrateRoutes(self):
+        workers = self.workers if self.workers > 0 else multiprocessing.cpu_count()
+        if workers > 1 and len( self.routes ) > 1 and self.parallelCalibrationAvailable():
+            self.calibrateRoutesParallel( workers )
+        else:
+            for route in self.routes.values():
+                route.calibrate(self.extrapolate)
+                self.progressStep(self.CALIBRATING_ROUTES) 
+
+    # Routes are independent, calibrate them in pool of processes and copy
+    # results (parts, records, milestones, errors) back to routes
+    def calibrateRoutesParallel(self, workers):
+        global calibrationRoutes, calibrationExtrapolate
+        # must be set before the pool is created (forked)
+        calibrationRoutes = self.routes
+        calibrationExtrapolate = self.extrapolate
+
+        pool = multiprocessing.Pool( workers )
+        try:
+            # bigger chunks to reduce communication overhead but keep workers busy
+            chunksize = max( 1, len( self.routes ) / ( 4 * workers ) )
+            for routeKey, state in pool.imap_unordered( calibrateRouteWorker, self.routes.keys(), chunksize ):
+                self.routes[routeKey].setCalibrationState( state )
+                self.progressStep(self.CALIBRATING_ROUTES) 
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            calibrationRoutes = {}
+
     # get route by id, create it if does not exist
     # routeId does not have to be normalized
     def getRoute(self, routeId):
@@ -291,21 +365,76 @@ class Lrs(QObject):
         route.removeLine( fid )
         del self.lines[fid]
 
+    # Returns QgsFeatureRequest to read features for registration, only route
+    # and measure attributes are fetched. In 'include' mode, selected routes are
+    # filtered by expression which may be evaluated by provider (e.g. PostGIS).
+    # The expression may return more features than selected (route ids are 
+    # normalized), features are always tested by routeIdSelected().
+    def getRegisterRequest(self, layer, routeField, fieldNames):
+        fields = layer.pendingFields()
+        request = QgsFeatureRequest()
+        request.setSubsetOfAttributes( [ fields.indexFromName( name ) for name in fieldNames ] )
+
+        expression = self.getSelectionExpression( fields.field( routeField ) )
+        if expression:
+            request.setFilterExpression( expression )
+        return request
+
+    # returns expression selecting features of selected routes in 'include' mode or None
+    def getSelectionExpression(self, field):
+        if self.selectionMode != 'include' or not self.selection: return None
+
+        column = QgsExpression.quotedColumnRef( field.name() )
+        if field.type() == QVariant.String:
+            # normalized route ids are lower case
+            values = [ QgsExpression.quotedString( routeId ) for routeId in self.selection ]
+            return 'lower(%s) IN (%s)' % ( column, ','.join( values ) )
+
+        if field.type() not in [ QVariant.Int, QVariant.UInt, QVariant.LongLong, QVariant.ULongLong, QVariant.Double ]:
+            return None
+
+        # numeric field, route ids which are not numbers cannot be selected,
+        # integers are written exactly (float would lose precision above 2^53)
+        values = []
+        for routeId in self.selection:
+            if field.type() == QVariant.Double:
+                try:
+                    value = float( routeId )
+                except ValueError:
+                    continue
+                if value - value == 0: # not nan or inf
+                    values.append( repr( value ) )
+            else:
+                try:
+                    values.append( str( int( routeId ) ) )
+                except ValueError:
+                    continue
+        if not values: values = [ 'NULL' ]
+        return '%s IN (%s)' % ( column, ','.join( values ) )
+
     def registerLines (self):
         self.routes = {}
-        for feature in self.lineLayer.getFeatures():
+        request = self.getRegisterRequest( self.lineLayer, self.lineRouteField, [ self.lineRouteField ] )
+        # total length of all lines is not known if features are filtered
+        if request.filterType() == QgsFeatureRequest.FilterExpression:
+            self.stats['length'] = None
+        nFeatures = 0
+        for feature in self.lineLayer.getFeatures( request ):
+            nFeatures += 1
             line = self.registerLineFeature(feature)
             #self.stats['lineFeatures'] += 1
             length = 0
             if feature.geometry():
                 length = self.distanceArea.measure( feature.geometry() )
-            self.stats['length'] += length
+            if self.stats['length'] is not None:
+                self.stats['length'] += length
             if line:
                 #self.stats['lineFeaturesIncluded'] += 1
                 #self.stats['linesIncluded'] += line.getNumParts()
                 self.stats['lengthIncluded'] += length
             self.progressStep(self.REGISTERING_LINES) 
-        # precise number of routes
+        # precise number of lines and routes
+        self.progressCounts[self.NLINES] = nFeatures
         self.progressCounts[self.NROUTES] = len( self.routes )
         self.updateProgressTotal()
 
@@ -340,13 +469,17 @@ class Lrs(QObject):
         del self.points[fid]
 
     def registerPoints (self):
-        for feature in self.pointLayer.getFeatures():
+        request = self.getRegisterRequest( self.pointLayer, self.pointRouteField, [ self.pointRouteField, self.pointMeasureField ] )
+        nFeatures = 0
+        for feature in self.pointLayer.getFeatures( request ):
+            nFeatures += 1
             point = self.registerPointFeature ( feature )
             #self.stats['pointFeatures'] += 1
             #if point:
                 #self.stats['pointFeaturesIncluded'] += 1
                 #self.stats['pointsIncluded'] += point.getNumParts()
             self.progressStep(self.REGISTERING_POINTS) 
+        self.progressCounts[self.NPOINTS] = nFeatures
         # route total may increase (e.g. orphans)
         self.progressCounts[self.NROUTES] = len( self.routes )
         self.updateProgressTotal()
@@ -363,18 +496,21 @@ class Lrs(QObject):
         return ids
 
     def getErrors(self):
+        self.recalibrateDirtyRoutes()
         errors = list ( self.errors )
         for route in self.routes.values():
             errors.extend( route.getErrors() )
         return errors
 
     def getParts(self):
+        self.recalibrateDirtyRoutes()
         parts = []
         for route in self.routes.values():
             parts.extend( route.parts )
         return parts
 
     def getSegments(self):
+        self.recalibrateDirtyRoutes()
         segments = []
         for route in self.routes.values():
             segments.extend( route.getSegments() )
@@ -382,11 +518,13 @@ class Lrs(QObject):
 
     # get list of available measures ( (from, to),.. )
     def getRouteMeasureRanges(self, routeId):
+        self.recalibrateDirtyRoutes()
         routeId = normalizeRouteId( routeId )
         if not self.routes.has_key( routeId ): return []
         return self.routes[routeId].getMeasureRanges()
 
     def getQualityFeatures(self):
+        self.recalibrateDirtyRoutes()
         features = []
         for route in self.routes.values():
             features.extend( route.getQualityFeatures() )
@@ -404,6 +542,7 @@ class Lrs(QObject):
 
     def pointLayerEditingStopped(self):
         self.pointEditBuffer = None
+        self.recalibrateDirtyRoutes()
 
     def pointLayerEditingDisconnect(self):
         if self.pointEditBuffer:
@@ -422,6 +561,7 @@ class Lrs(QObject):
 
     def lineLayerEditingStopped(self):
         self.lineEditBuffer = None
+        self.recalibrateDirtyRoutes()
 
     def lineLayerEditingDisconnect(self):
         if self.lineEditBuffer:
@@ -441,6 +581,27 @@ class Lrs(QObject):
         errorUpdates['crs'] = self.crs
         self.updateErrors.emit ( errorUpdates )
 
+    # mark route to be recalibrated after edit, routes are recalibrated
+    # when edit signals stop for a while, on commit or before data are queried
+    def recalibrateRoute(self, route):
+        self.dirtyRoutes[ normalizeRouteId( route.routeId ) ] = route
+        self.recalibrateTimer.start()
+
+    # recalibrate edited routes, update segment index and emit single errors update
+    def recalibrateDirtyRoutes(self):
+        self.recalibrateTimer.stop()
+        if not self.dirtyRoutes: return
+        routes = self.dirtyRoutes.values()
+        self.dirtyRoutes = {}
+
+        errorUpdates = {}
+        for route in routes:
+            routeUpdates = route.calibrateAndGetUpdates(self.extrapolate)
+            self.updateSegmentIndex( route )
+            for name, values in routeUpdates.iteritems():
+                errorUpdates.setdefault( name, [] ).extend( values )
+        self.emitUpdateErrors( errorUpdates )
+
     # Warning: featureAdded is called first with temporary (negative fid)
     # then, when changes are commited, featureDeleted is called with that 
     # temporary id and featureAdded with real new id,
@@ -456,8 +617,7 @@ class Lrs(QObject):
         if not point: return # route id not in selection
 
         route = self.getRoute( point.routeId )
-        errorUpdates = route.calibrateAndGetUpdates(self.extrapolate)
-        self.emitUpdateErrors( errorUpdates )
+        self.recalibrateRoute( route )
 
     def pointFeatureDeleted( self, fid ):
         #debug ( "feature deleted fid %s" % fid )
@@ -468,8 +628,7 @@ class Lrs(QObject):
 
         route = self.getRoute( point.routeId )
         self.unregisterPointByFid(fid)
-        errorUpdates = route.calibrateAndGetUpdates(self.extrapolate)
-        self.emitUpdateErrors( errorUpdates )
+        self.recalibrateRoute( route )
             
     def pointGeometryChanged( self, fid, geo ):
         #debug ( "geometry changed fid %s" % fid )
@@ -486,8 +645,7 @@ class Lrs(QObject):
         feature = getLayerFeature( self.pointLayer, fid )
         self.registerPointFeature ( feature )
 
-        errorUpdates = route.calibrateAndGetUpdates(self.extrapolate)
-        self.emitUpdateErrors( errorUpdates )
+        self.recalibrateRoute( route )
 
     def pointAttributeValueChanged( self, fid, attIdx, value ):
         #debug ( "attribute changed fid = %s attIdx = %s value = %s " % (fid, attIdx, value) )
@@ -506,15 +664,13 @@ class Lrs(QObject):
 
                 if attIdx == routeIdx:
                     # recalibrate old
-                    errorUpdates = route.calibrateAndGetUpdates(self.extrapolate)
-                    self.emitUpdateErrors( errorUpdates )
+                    self.recalibrateRoute( route )
 
             feature = getLayerFeature( self.pointLayer, fid )
             point = self.registerPointFeature ( feature ) # returns LrsPoint
             if point: # route id in selection
                 route = self.getRoute( point.routeId )
-                errorUpdates = route.calibrateAndGetUpdates(self.extrapolate)
-                self.emitUpdateErrors( errorUpdates )
+                self.recalibrateRoute( route )
     
     #### line edit ####
     def lineFeatureAdded( self, fid ):
@@ -526,8 +682,7 @@ class Lrs(QObject):
         if not line: return # route id not in selection
 
         route = self.getRoute( line.routeId )
-        errorUpdates = route.calibrateAndGetUpdates(self.extrapolate)
-        self.emitUpdateErrors( errorUpdates )
+        self.recalibrateRoute( route )
 
     def lineFeatureDeleted( self, fid ):
         #debug ( "feature deleted fid %s" % fid )
@@ -538,8 +693,7 @@ class Lrs(QObject):
 
         route = self.getRoute( line.routeId )
         self.unregisterLineByFid(fid)
-        errorUpdates = route.calibrateAndGetUpdates(self.extrapolate)
-        self.emitUpdateErrors( errorUpdates )
+        self.recalibrateRoute( route )
             
     def lineGeometryChanged( self, fid, geo ):
         #debug ( "geometry changed fid %s" % fid )
@@ -556,8 +710,7 @@ class Lrs(QObject):
         feature = getLayerFeature( self.lineLayer, fid )
         self.registerLineFeature ( feature )
 
-        errorUpdates = route.calibrateAndGetUpdates(self.extrapolate)
-        self.emitUpdateErrors( errorUpdates )
+        self.recalibrateRoute( route )
 
     def lineAttributeValueChanged( self, fid, attIdx, value ):
         #debug ( "attribute changed fid = %s attIdx = %s value = %s " % (fid, attIdx, value) )
@@ -572,16 +725,14 @@ class Lrs(QObject):
             if line: # was in selection
                 route = self.getRoute( line.routeId )
                 self.unregisterLineByFid(fid)
-                errorUpdates = route.calibrateAndGetUpdates(self.extrapolate)
-                self.emitUpdateErrors( errorUpdates )
+                self.recalibrateRoute( route )
 
             feature = getLayerFeature( self.lineLayer, fid )
 
             line = self.registerLineFeature ( feature ) # returns LrsLine
             if line: # route id in selection
                 route = self.getRoute( line.routeId )
-                errorUpdates = route.calibrateAndGetUpdates(self.extrapolate)
-                self.emitUpdateErrors( errorUpdates )
+                self.recalibrateRoute( route )
 
 ##################### EVENTS ######################################
 
@@ -605,6 +756,7 @@ class Lrs(QObject):
     # tolerance - maximum accepted measure from start to nearest existing lrs if exact start measure was not found
     # returns ( QgsPoint, error )
     def eventPoint(self, routeId, start, tolerance=0):
+        self.recalibrateDirtyRoutes()
         error = self.eventValuesError( routeId, start)
         if error: return None, error
 
@@ -612,9 +764,62 @@ class Lrs(QObject):
         geo, error = route.eventPoint( start, tolerance  )
         return geo, error
         
+    # check events values and group valid events by route
+    # returns ( list of errors or None, { normalized route id: list of event indices } )
+    def eventsByRoute(self, routeIds, starts, ends = None, linear = False):
+        self.recalibrateDirtyRoutes()
+        errors = [ None ] * len(routeIds)
+        valuesErrors = {} # ( routeId, start is None, end is None ): error
+        normalIds = {} # routeId: normalized route id
+        routeEvents = {} # normalized route id: list of event indices
+        for i in range(len(routeIds)):
+            routeId = routeIds[i]
+            end = ends[i] if linear else None
+            key = ( routeId, starts[i] is None, end is None )
+            if not valuesErrors.has_key( key ):
+                valuesErrors[key] = self.eventValuesError( routeId, starts[i], end, linear )
+                normalIds[routeId] = normalizeRouteId( routeId )
+            errors[i] = valuesErrors[key]
+            if errors[i]: continue
+
+            routeEvents.setdefault( normalIds[routeId], [] ).append( i )
+
+        return errors, routeEvents
+
+    # batch version of eventPoint, events are resolved together for each route
+    # returns ( list of QgsPoint or None, list of errors or None )
+    def eventPoints(self, routeIds, starts, tolerance=0):
+        points = [ None ] * len(routeIds)
+        errors, routeEvents = self.eventsByRoute( routeIds, starts )
+
+        for normalId, indices in routeEvents.iteritems():
+            route = self.routes[normalId]
+            routePoints, routeErrors = route.eventPoints( [ starts[i] for i in indices ], tolerance )
+            for j in range(len(indices)):
+                points[ indices[j] ] = routePoints[j]
+                errors[ indices[j] ] = routeErrors[j]
+
+        return points, errors
+
+    # batch version of eventMultiPolyLine, events are resolved together for each route
+    # returns ( list of QgsMultiPolyline or None, list of errors or None )
+    def eventMultiPolyLines(self, routeIds, starts, ends, tolerance=0):
+        multipolylines = [ None ] * len(routeIds)
+        errors, routeEvents = self.eventsByRoute( routeIds, starts, ends, True )
+
+        for normalId, indices in routeEvents.iteritems():
+            route = self.routes[normalId]
+            routeLines, routeErrors = route.eventMultiPolyLines( [ starts[i] for i in indices ], [ ends[i] for i in indices ], tolerance )
+            for j in range(len(indices)):
+                multipolylines[ indices[j] ] = routeLines[j]
+                errors[ indices[j] ] = routeErrors[j]
+
+        return multipolylines, errors
+
     # tolerance - minimum missing gap which will be reported as error
     # returns ( QgsMultiPolyline, error )
     def eventMultiPolyLine(self, routeId, start, end, tolerance=0):
+        self.recalibrateDirtyRoutes()
         error = self.eventValuesError( routeId, start, end, True)
         if error: return None, error
 
@@ -624,52 +829,74 @@ class Lrs(QObject):
 
 ############################# MEASURE ####################################
 
-    def deletePartSpatialIndex(self):
-        if self.partSpatialIndex:
-            del self.partSpatialIndex
-        self.partSpatialIndex = None
-        self.partSpatialIndexRoutePart = None
-
-    def createPartSpatialIndex(self):
-        self.deletePartSpatialIndex()
-        self.partSpatialIndex = QgsSpatialIndex()
-        self.partSpatialIndexRoutePart = {}
-        fid = 1
+    def deleteSegmentIndex(self):
+        self.segmentIndex = None
+        self.segmentIndexRouteParts = None
+
+    # parts polylines are in index under key ( normalized route id, partIdx )
+    def createSegmentIndex(self):
+        self.segmentIndex = LrsSegmentIndex()
+        self.segmentIndexRouteParts = {} # normalized route id: number of parts in index
         for route in self.routes.values():
-            for i in range(len(route.parts)):
-                feature = QgsFeature(fid)
-                geo = QgsGeometry.fromPolyline( route.parts[i].polyline )
-                feature.setGeometry( geo )
-                self.partSpatialIndex.insertFeature( feature )
-                self.partSpatialIndexRoutePart[fid] = [ route.routeId, i ]
-                fid += 1
+            self.updateSegmentIndex( route )
+
+    # replace route parts in segment index after route was recalibrated,
+    # index is created later on request if it does not exist
+    def updateSegmentIndex(self, route):
+        if self.segmentIndex is None: return
+        normalId = normalizeRouteId( route.routeId )
+        for i in range( self.segmentIndexRouteParts.get( normalId, 0 ) ):
+            self.segmentIndex.delete( ( normalId, i ) )
+        for i in range(len(route.parts)):
+            self.segmentIndex.insert( ( normalId, i ), route.parts[i].polyline )
+        self.segmentIndexRouteParts[normalId] = len(route.parts)
+
+    # batch version of pointMeasure for points given by lists of coordinates
+    # returns ( list of routeId or None, list of measure or None )
+    def pointMeasures ( self, xs, ys, threshold ):
+        self.recalibrateDirtyRoutes()
+        if self.segmentIndex is None:
+            self.createSegmentIndex()
+        routeIds = [ None ] * len(xs)
+        measures = [ None ] * len(xs)
+
+        partPoints = {} # polyline key: [ [ point index, segment, nearest point ], ... ]
+        nearestSegments = self.segmentIndex.nearestSegments( xs, ys, threshold )
+        for k in range(len(xs)):
+            if nearestSegments[k] is None: continue
+            ( sqDist, polylineKey, segment, nearestPnt ) = nearestSegments[k]
+            partPoints.setdefault( polylineKey, [] ).append( [ k, segment, nearestPnt ] )
+
+        for ( normalId, partIdx ), points in partPoints.iteritems():
+            route = self.routes[normalId]
+            routeId = route.routeId
+            part = route.parts[partIdx]
+            partMeasures = [ measureAlongPolyline( part.polyline, segment, nearestPnt, part.getDistances() ) for k, segment, nearestPnt in points ]
+            partMilestoneMeasures = part.getMilestoneMeasures( partMeasures )
+            for j in range(len(points)):
+                k = points[j][0]
+                routeIds[k] = routeId
+                measures[k] = partMilestoneMeasures[j]
+
+        return routeIds, measures
+
+    # returns [ routeId, partIdx, segment, nearestPnt ] of nearest part segment 
+    # within threshold or None
+    def nearestRoutePartSegment(self, point, threshold ):
+        self.recalibrateDirtyRoutes()
+        if self.segmentIndex is None:
+            self.createSegmentIndex()
+        nearest = self.segmentIndex.nearestSegment( point, threshold )
+        if nearest is None: return None
+        ( sqDist, ( normalId, partIdx ), segment, nearestPnt ) = nearest
+        return [ self.routes[normalId].routeId, partIdx, segment, nearestPnt ]
 
     # returns nearest routeId, partIdx within threshold 
     def nearestRoutePart(self, point, threshold ):
-        if not self.partSpatialIndex:
-            self.createPartSpatialIndex()
-        rect = QgsRectangle( point.x()-threshold, point.y()-threshold, point.x()+threshold, point.y()+threshold )
-        ids = self.partSpatialIndex.intersects( rect )
-        #debug ( '%s' % ids )
-        nearestRouteId = None
-        nearestPartIdx = None
-        nearestDist = sys.float_info.max
-        for id in ids:
-            routeId, partIdx = self.partSpatialIndexRoutePart[id]
-            route = self.getRoute( routeId )
-            part = route.parts[partIdx]
-            geo = QgsGeometry.fromPolyline( part.polyline )
-            ( sqDist, nearestPnt, afterVertex ) = geo.closestSegmentWithContext( point )
-            dist = math.sqrt( sqDist )
-            if dist < nearestDist:
-                nearestDist = dist
-                nearestRouteId = routeId
-                nearestPartIdx = partIdx
-    
-        if nearestDist <= threshold:
-            return nearestRouteId, nearestPartIdx
-
-        return None, None
+        nearest = self.nearestRoutePartSegment( point, threshold )
+        if nearest is None:
+            return None, None
+        return nearest[0], nearest[1]
 
     # return routeId, measure
     # Note: it may happen that nearest point (projected) has no record on part,
@@ -678,21 +905,20 @@ class Lrs(QObject):
     # TODO: search for nearest available referenced segments (records) instead 
     # of part polylines?
     def pointMeasure ( self, point, threshold ):
-        routeId, partIdx = self.nearestRoutePart( point, threshold)
-        if routeId is not None and partIdx is not None:
-            route = self.getRoute( routeId )
-            part = route.parts[partIdx]
-            measure = part.pointMeasure( point )
-            if measure is not None:
-                return routeId, measure
-            
-        return routeId, None
+        nearest = self.nearestRoutePartSegment( point, threshold )
+        if nearest is None:
+            return None, None
+        routeId, partIdx, segment, nearestPnt = nearest
+        part = self.getRoute( routeId ).parts[partIdx]
+        partMeasure = measureAlongPolyline( part.polyline, segment, nearestPnt, part.getDistances() )
+        return routeId, part.getMilestoneMeasure( partMeasure )
 
 ######################### STATS ####################################
 
     def getStatsHtmlRow(self, name, label):
         #return "%s : %s<br>" % ( label, self.stats[name] )
         value = self.stats[name]
+        if value is None: value = 'unknown'
         # lengths are in map units not in measure units
         #if 'length' in name.lower():
         #    value = formatMeasure( value, self.measureUnit )
@@ -615,15 +615,13 @@ class LrsDockWidget( QDockWidget, Ui_LrsDockWidget ):
     def resetErrorPointLayer(self):
         #debug ( "resetErrorPointLayer %s" % self.errorPointLayer )
         if not self.errorPointLayerManager: return
-        self.errorPointLayerManager.clear()
         errors = self.lrs.getErrors()
-        self.errorPointLayerManager.addErrors( errors, self.lrs.crs )
+        self.errorPointLayerManager.reloadErrors( errors, self.lrs.crs )
 
     def resetErrorLineLayer(self):
         if not self.errorLineLayerManager: return
-        self.errorLineLayerManager.clear()
         errors = self.lrs.getErrors()
-        self.errorLineLayerManager.addErrors( errors, self.lrs.crs )
+        self.errorLineLayerManager.reloadErrors( errors, self.lrs.crs )
 
     def addQualityLayer(self):
         if not self.qualityLayer:
@@ -638,9 +636,8 @@ class LrsDockWidget( QDockWidget, Ui_LrsDockWidget ):
     def resetQualityLayer(self):
         #debug ( "resetQualityLayer %s" % self.qualityLayer )
         if not self.qualityLayerManager: return
-        self.qualityLayerManager.clear()
         features = self.lrs.getQualityFeatures()
-        self.qualityLayerManager.addFeatures( features, self.lrs.crs )
+        self.qualityLayerManager.reload( features, self.lrs.crs )
 
 ############################# LOCATE ###############################################
 
@@ -827,13 +824,43 @@ class LrsDockWidget( QDockWidget, Ui_LrsDockWidget ):
 
         outputFeatures = []
         fields = outputLayer.pendingFields()
-        total = layer.featureCount()
+
+        # events are resolved at once, the first pass reads only event values
+        # and input features are read again to create output features, so that
+        # all input features are not kept in memory
+        eventFieldNames = [ name for name in [ routeFieldName, startFieldName, endFieldName ] if name ]
+        request = QgsFeatureRequest().setFlags( QgsFeatureRequest.NoGeometry )
+        request.setSubsetOfAttributes( [ layer.pendingFields().indexFromName( name ) for name in eventFieldNames ] )
+        fids = []
+        routeIds = []
+        starts = []
+        ends = []
+        for feature in layer.getFeatures( request ):
+            fids.append( feature.id() )
+            routeIds.append( feature[routeFieldName] )
+            starts.append( feature[startFieldName] )
+            if endFieldName:
+                ends.append( feature[endFieldName] )
+        total = len( fids )
         count = 0
-        for feature in layer.getFeatures():
-            routeId = feature[routeFieldName]
-            start = feature[startFieldName]
-            end = feature[endFieldName] if endFieldName else None
-            #debug ( "event routeId = %s start = %s end = %s" % ( routeId, start, end ) )
+
+        if endFieldName:
+            geometries, errors = self.lrs.eventMultiPolyLines ( routeIds, starts, ends, eventTolerance )
+        else:
+            geometries, errors = self.lrs.eventPoints ( routeIds, starts, eventTolerance )
+
+        # features are expected in the same order as in the first pass 
+        fidIndices = None # fid: event index, used only if order differs
+        nextIdx = 0
+        for feature in layer.getFeatures( QgsFeatureRequest().setFlags( QgsFeatureRequest.NoGeometry ) ):
+            i = nextIdx
+            if i >= total or fids[i] != feature.id():
+                if fidIndices is None:
+                    fidIndices = dict( zip( fids, range(total) ) )
+                i = fidIndices.get( feature.id() )
+                if i is None: continue # feature added meanwhile
+            nextIdx = i + 1
+            #debug ( "event routeId = %s start = %s" % ( routeIds[i], starts[i] ) )
 
             outputFeature = QgsFeature( fields ) # fields must exist during feature life!
             for field in layer.pendingFields():
@@ -841,12 +868,13 @@ class LrsDockWidget( QDockWidget, Ui_LrsDockWidget ):
                     outputFeature[field.name()] = feature[field.name()]
             
             geo = None
+            error = errors[i]
             if endFieldName:
-                line, error = self.lrs.eventMultiPolyLine ( routeId, start, end, eventTolerance )
+                line = geometries[i]
                 if line:
                     geo = QgsGeometry.fromMultiPolyline( line )
             else:
-                point, error = self.lrs.eventPoint ( routeId, start, eventTolerance )
+                point = geometries[i]
                 if point:
                     geo = QgsGeometry.fromPoint( point )
             
@@ -956,6 +984,9 @@ class LrsDockWidget( QDockWidget, Ui_LrsDockWidget ):
         transform = None
         if layer.crs() != self.lrs.crs:
             transform = QgsCoordinateTransform( layer.crs(), self.lrs.crs)
+        # output features and points in lrs crs, measures are calculated at once
+        xs = []
+        ys = []
         for feature in layer.getFeatures():
             points = []
             
@@ -976,12 +1007,8 @@ class LrsDockWidget( QDockWidget, Ui_LrsDockWidget ):
                 
                 if transform:
                     point = transform.transform( point )
-                routeId, measure = self.lrs.pointMeasure ( point, threshold )
-                #debug ( "routeId = %s merasure = %s" % (routeId, measure) )
-
-                if routeId is not None:
-                    outputFeature[routeFieldName] = '%s' % routeId
-                outputFeature[measureFieldName] = measure
+                xs.append( point.x() )
+                ys.append( point.y() )
 
                 outputFeatures.append( outputFeature )
 
@@ -989,6 +1016,13 @@ class LrsDockWidget( QDockWidget, Ui_LrsDockWidget ):
             percent = 100 * count / total;
             self.measureProgressBar.setValue( percent)
 
+        routeIds, measures = self.lrs.pointMeasures ( xs, ys, threshold )
+        for i in range(len(outputFeatures)):
+            #debug ( "routeId = %s merasure = %s" % (routeIds[i], measures[i]) )
+            if routeIds[i] is not None:
+                outputFeatures[i][routeFieldName] = '%s' % routeIds[i]
+            outputFeatures[i][measureFieldName] = measures[i]
+
         outputLayer.dataProvider().addFeatures( outputFeatures )
         
 
@@ -27,6 +27,7 @@ from qgis.core import *
 from utils import *
 
 class LrsMilestone(object):
+    __slots__ = ( 'fid', 'geoPart', 'nGeoParts', 'pnt', 'measure', 'partIdx', 'partMeasure' )
 
     def __init__(self, fid, geoPart, nGeoParts, pnt, measure):
         self.fid = fid # point 
@@ -36,6 +37,6 @@ class LrsMilestone(object):
         self.nGeoParts = nGeoParts
         self.pnt = pnt   # QgsPoint
         self.measure = measure # field measure
-        self.part = None # part index
+        self.partIdx = None # part index
         # distance from beginning of part to the point on part nearest to pnt
         self.partMeasure = None 
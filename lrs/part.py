@@ -19,6 +19,8 @@
  *                                                                         *
  ***************************************************************************/
 """
+import bisect
+from functools import partial
 # Import the PyQt and QGIS libraries
 from PyQt4.QtCore import *
 #from PyQt4.QtGui import *
@@ -28,7 +30,9 @@ from utils import *
 from error import *
 
 # calibration record
-class LrsRecord:
+class LrsRecord(object):
+    __slots__ = ( 'milestoneFrom', 'milestoneTo', 'partFrom', 'partTo' )
+
     def __init__(self, milestoneFrom, milestoneTo, partFrom, partTo):
         # measures from mileston measure attribute
         self.milestoneFrom = milestoneFrom
@@ -111,20 +115,45 @@ class LrsRoutePart:
         self.records = [] # LrsRecord list
         self.errors = [] # LrsError list
 
-    def setPolyline(self,polyline):
+    # coordinates: optional numpy array of polyline coordinates if already available
+    def setPolyline(self, polyline, coordinates = None):
         self.polyline = polyline
-        # QgsGeometry.fromPolyline() returns None if plyline has only one point
-        self.polylineGeo = QgsGeometry.fromPolyline( self.polyline ) 
-        if self.polylineGeo is not None:    
-            self.length = self.polylineGeo.length()
-        else:
-            self.length = 0
+        # cached numpy array of coordinates (if numpy is available)
+        self.coordinates_ = coordinates
+        # cached distances of polyline vertices from the beginning
+        self.distances_ = None
+        # cached QgsGeometry
+        self.polylineGeo_ = None
+        self.length = self.getDistances()[-1]
+
+    # returns numpy array of polyline coordinates or None if numpy is not available
+    def getCoordinates(self):
+        if self.coordinates_ is None and haveNumpy:
+            self.coordinates_ = polylineCoordinates( self.polyline )
+        return self.coordinates_
+
+    # returns distances of polyline vertices from the beginning
+    def getDistances(self):
+        if self.distances_ is None:
+            self.distances_ = polylineDistances( self.polyline, self.getCoordinates() )
+        return self.distances_
+
+    # QgsGeometry.fromPolyline() returns None if plyline has only one point
+    def getPolylineGeo(self):
+        if self.polylineGeo_ is None:
+            self.polylineGeo_ = QgsGeometry.fromPolyline( self.polyline ) 
+        return self.polylineGeo_
+
+    def reverse(self):
+        coordinates = self.coordinates_[::-1] if self.coordinates_ is not None else None
+        self.polyline.reverse()
+        self.setPolyline( self.polyline, coordinates )
 
     def calibrate(self):
         #debug ( 'calibrate part routeId = %s' % self.routeId )
 
         if len ( self.milestones ) < 2:
-            self.errors.append( LrsError( LrsError.NOT_ENOUGH_MILESTONES, self.polylineGeo, routeId = self.routeId, origins = self.origins ))
+            self.errors.append( LrsError( LrsError.NOT_ENOUGH_MILESTONES, self.getPolylineGeo(), routeId = self.routeId, origins = self.origins ))
             return
 
         # create list of milestones sorted by partMeasure
@@ -147,11 +176,10 @@ class LrsRoutePart:
                 down += 1
 
         if up == down:
-            self.errors.append( LrsError( LrsError.DIRECTION_GUESS, self.polylineGeo, routeId = self.routeId, origins = self.origins  ))
+            self.errors.append( LrsError( LrsError.DIRECTION_GUESS, self.getPolylineGeo(), routeId = self.routeId, origins = self.origins  ))
             return
         elif down > up: # revert
-            self.polyline.reverse()
-            self.setPolyline( self.polyline ) # create polylineGeo
+            self.reverse()
             milestones.reverse()
             # recalc partMeasures
             for milestone in milestones:
@@ -165,44 +193,24 @@ class LrsRoutePart:
         #     While there are milestones in wrong order:
         #         * for each milestones calculate correctness score
         #         * mark as error all milestones with lowest score
+        # score: number of milestones to which it is in correct order minus 
+        #        number of milestones to which it is in wrong order,
+        #        if both have the same measure, it is considered wrong order,
+        #        i.e. score = n - 1 - 2 * wrong, lowest score = most wrong
          
         while True:
-            done = True
-
-            # calculate scores
-            # score: number of milestones to which it is in correct order minus 
-            #        number of milestones to which it is in wrong order,
-            #        if both have the same measure, it is considered wrong order
-            scores = []
-
-            for i in range(len(milestones)):
-                score = 0
-                for j in range(len(milestones)):
-                    if i == j: continue
-                    mi = milestones[i].measure
-                    mj = milestones[j].measure
-                    if (i < j and mi < mj) or (i > j and mi > mj ):
-                        score += 1
-                    else:
-                        score -= 1 # includes equal measures
-                        done = False # at least one in wron order
-
-                scores.append( score )
-
-            if done: break # all in crorrect order
-
-            # find lowest score
-            minScore = sys.maxint
-            for i in range(len(scores)):
-                if scores[i] < minScore: minScore = scores[i]
+            wrongs = wrongOrderCounts( [ milestone.measure for milestone in milestones ] )
+
+            maxWrong = max( wrongs ) if wrongs else 0
+            if maxWrong == 0: break # all in correct order
 
             # mark all with lowest score as errors, if more neighbours have the same score
             # e.g. measures: 3,0,4,5, both 3 and 0 have score +1, both are marked as 
             # error because we cannot decide which is correct
             for i in range(len(milestones)-1,-1,-1):
-                if scores[i] == minScore:
+                if wrongs[i] == maxWrong:
                     m = milestones[i]
-                    geo = QgsGeometry.fromPoint( m.pnt )
+                    geo = partial( QgsGeometry.fromPoint, m.pnt )
                     origin = LrsOrigin( QGis.Point, m.fid, m.geoPart, m.nGeoParts )
                     self.errors.append( LrsError( LrsError.WRONG_MEASURE, geo, routeId = self.routeId, measure = m.measure, origins = [ origin ] ))
                     del  milestones[i]
@@ -221,7 +229,7 @@ class LrsRoutePart:
     # calculate segment measure in measure units, used for extrapolate
     def segmentLengthInMeasureUnits(self, partFrom, partTo ):
         if self.distanceArea.ellipsoidalEnabled():
-            polyline = polylineSegment( self.polyline, partFrom, partTo )
+            polyline = polylineSegment( self.polyline, partFrom, partTo, self.getDistances() )
             geo = QgsGeometry.fromPolyline( polyline )
             length = self.distanceArea.measure( geo )
             qgisUnit = QGis.Meters
@@ -255,6 +263,25 @@ class LrsRoutePart:
             self.records.append( LrsRecord ( record.milestoneTo, measure, record.partTo, self.length ) )
         
 
+    # plain picklable calibration data, milestones are given as indices
+    # to route milestones list
+    def getCalibrationState(self, milestoneIndices):
+        return {
+            'polyline': [ ( p.x(), p.y() ) for p in self.polyline ],
+            'origins': [ origin.getState() for origin in self.origins ],
+            'milestones': [ milestoneIndices[id(m)] for m in self.milestones ],
+            'goodMilestones': [ milestoneIndices[id(m)] for m in self.goodMilestones ],
+            'records': [ ( r.milestoneFrom, r.milestoneTo, r.partFrom, r.partTo ) for r in self.records ],
+            'errors': [ error.getState() for error in self.errors ],
+        }
+
+    # restore calibration from getCalibrationState() data, milestones is route milestones list
+    def setCalibrationState(self, state, milestones):
+        self.milestones = [ milestones[i] for i in state['milestones'] ]
+        self.goodMilestones = [ milestones[i] for i in state['goodMilestones'] ]
+        self.records = [ LrsRecord( *record ) for record in state['records'] ]
+        self.errors = [ LrsError.fromState( error ) for error in state['errors'] ]
+
     def getGoodMilestones(self):
         return self.goodMilestones
 
@@ -265,7 +292,7 @@ class LrsRoutePart:
         self.records.remove( record )
 
     def getRecordGeometry(self, record):
-        polyline = polylineSegment( self.polyline, record.partFrom, record.partTo )
+        polyline = polylineSegment( self.polyline, record.partFrom, record.partTo, self.getDistances() )
         geo = QgsGeometry.fromPolyline( polyline )
         return geo
 
@@ -302,8 +329,9 @@ class LrsRoutePart:
     def getErrors(self):
         return self.errors
 
+    # returns QgsPoint in partMeasure or None
     def getPoint(self, partMeasure):
-        self.polyline
+        return polylinePoint( self.polyline, partMeasure, self.getDistances() )
 
     # returns QgsPoint or None
     def eventPoint(self, start):
@@ -313,13 +341,23 @@ class LrsRoutePart:
         start = float(start)
         for record in self.records:
             if record.containsMeasure( start ):
-                m = record.partMeasure( start )
-                point = polylinePoint ( self.polyline, m )
-                return point
+                return self.recordPoint( record, start )
         return None
 
+    # returns point for measure on record
+    def recordPoint(self, record, measure):
+        m = record.partMeasure( measure )
+        point = polylinePoint ( self.polyline, m, self.getDistances() )
+        return point
+
+    # returns list of points for measures on records given by indices
+    def recordPoints(self, recordIndices, measures):
+        partMeasures = [ self.records[recordIndices[i]].partMeasure( measures[i] ) for i in range(len(measures)) ]
+        return polylinePoints( self.polyline, partMeasures, self.getDistances(), self.getCoordinates() )
+
     # returns [ [ QgsPolyline, measure_from, measure_to ], ... ]
-    def eventSegments(self, start, end):
+    # firstRecord: index of the first record to be searched, records before it must end before start
+    def eventSegments(self, start, end, firstRecord = 0):
         #debug ( "eventSegments start = %s end = %s" % (start,end) )
         segments = []
         if start is None or end is None: return segments
@@ -327,47 +365,47 @@ class LrsRoutePart:
         end = float(end)
 
         # segment values
-        seg = LrsRecord(None,None,None,None)
+        segFrom = segTo = segPartFrom = segPartTo = None
         nrecords = len(self.records)
-        for i in range(nrecords):
+        for i in range(firstRecord, nrecords):
             record = self.records[i]
             nextRecord = self.records[i+1] if i < nrecords -1 else None
 
             if end < record.milestoneFrom: break
 
             #debug ( "record.milestoneFrom = %s record.milestoneTo = %s" % ( record.milestoneFrom, record.milestoneTo ) )
-            if seg.milestoneFrom is None:
+            if segFrom is None:
                 if start <= record.milestoneFrom:
                     #debug ( "start before or at record.milestoneFrom" )
-                    seg.milestoneFrom = record.milestoneFrom
-                    seg.partFrom = record.partFrom
+                    segFrom = record.milestoneFrom
+                    segPartFrom = record.partFrom
                 elif record.measureWithin( start ):
-                    seg.milestoneFrom = start
-                    seg.partFrom = record.partMeasure( start )
+                    segFrom = start
+                    segPartFrom = record.partMeasure( start )
 
-            if seg.milestoneFrom is not None:
+            if segFrom is not None:
                 if end == record.milestoneTo:
                     #debug ( "end at record.milestoneTo" )
-                    seg.milestoneTo = record.milestoneTo
-                    seg.partTo = record.partTo
+                    segTo = record.milestoneTo
+                    segPartTo = record.partTo
                 elif record.measureWithin( end ):
                     #debug ( "end within record" )
-                    seg.milestoneTo = end
-                    seg.partTo = record.partMeasure( end )
+                    segTo = end
+                    segPartTo = record.partMeasure( end )
                 elif nextRecord and record.continues( nextRecord ):
                     #debug ( "next record continues" )
                     pass
                 else:
-                    #debug ( "seg.milestoneTo set tot record.milestoneTo" )
-                    seg.milestoneTo = record.milestoneTo
-                    seg.partTo = record.partTo
+                    #debug ( "segTo set to record.milestoneTo" )
+                    segTo = record.milestoneTo
+                    segPartTo = record.partTo
                     
-            if seg.milestoneTo is not None:
-                polyline = polylineSegment( self.polyline, seg.partFrom, seg.partTo )
-                segments.append( [ polyline, seg.milestoneFrom, seg.milestoneTo ] )
+            if segTo is not None:
+                polyline = polylineSegment( self.polyline, segPartFrom, segPartTo, self.getDistances() )
+                segments.append( [ polyline, segFrom, segTo ] )
                 
-                start = seg.milestoneTo 
-                seg = LrsRecord(None,None,None,None)
+                start = segTo 
+                segFrom = segTo = segPartFrom = segPartTo = None
 
 
             if doubleNear ( start, end ): break
@@ -377,10 +415,9 @@ class LrsRoutePart:
     # get measure for nearest point on polyline
     # returns None if there is no record for the nearest point
     def pointMeasure ( self, point ):
-        geo = QgsGeometry.fromPolyline( self.polyline )
-        ( sqDist, nearestPoint, afterVertex ) = geo.closestSegmentWithContext( point )
+        ( sqDist, nearestPoint, afterVertex ) = self.getPolylineGeo().closestSegmentWithContext( point )
         segment = afterVertex-1
-        partMeasure = measureAlongPolyline( self.polyline, segment, nearestPoint )
+        partMeasure = measureAlongPolyline( self.polyline, segment, nearestPoint, self.getDistances() )
 
         return self.getMilestoneMeasure( partMeasure )
 
@@ -393,6 +430,20 @@ class LrsRoutePart:
 
         return None
 
+    # batch version of getMilestoneMeasure
+    def getMilestoneMeasures(self, partMeasures):
+        # records are ordered along part, the first record ending 
+        # at or after partMeasure is the first which may contain it
+        partTos = [ record.partTo for record in self.records ]
+        measures = []
+        for partMeasure in partMeasures:
+            i = bisect.bisect_left( partTos, partMeasure )
+            if i < len(self.records) and self.records[i].containsPartMeasure( partMeasure ):
+                measures.append( self.records[i].measure( partMeasure ) )
+            else:
+                measures.append( None )
+        return measures
+
     # beginning of first record
     def milestoneMeasureFrom(self):
         if not self.records: return None
@@ -410,42 +461,51 @@ class LrsRoutePart:
         coors = []
         if not self.records: return coors
 
-        # get measures for polyline
-        partMeasure = 0
+        # get measures for polyline vertices, both vertices and records 
+        # are ordered along part, so that records may be walked in parallel
+        distances = self.getDistances()
+        vertexCoors = []
+        r = 0
         for i in range(len(self.polyline)):
-            if i > 0:
-                partMeasure += segmentLength( self.polyline, i-1 )
-            #debug('partMeasure = %s' % partMeasure )
-            measure = self.getMilestoneMeasure( partMeasure )
-            #debug('measure = %s' % measure )
-            if measure is not None:
+            partMeasure = distances[i]
+            # skip records ending before vertex
+            while r < len(self.records) and self.records[r].partTo < partMeasure:
+                r += 1
+            if r == len(self.records): break
+
+            record = self.records[r]
+            if record.containsPartMeasure( partMeasure ):
                 point = self.polyline[i]
-                coor = [ point.x(), point.y(), measure ]
-                coors.append ( coor )
+                vertexCoors.append( [ point.x(), point.y(), record.measure( partMeasure ) ] )
 
-        #debug('coors: %s' % coors )
-        # add coordinates for milestones
+        # coordinates for milestones
+        milestoneCoors = []
         for record in self.records:
-            point = polylinePoint ( self.polyline, record.partFrom )
+            point = polylinePoint ( self.polyline, record.partFrom, distances )
             if point:
-                coor = [ point.x(), point.y(), record.milestoneFrom ]
-                coors.append ( coor )
+                milestoneCoors.append( [ point.x(), point.y(), record.milestoneFrom ] )
 
-        point = polylinePoint ( self.polyline, self.records[-1].partTo )
+        point = polylinePoint ( self.polyline, self.records[-1].partTo, distances )
         if point:
-            coor = [ point.x(), point.y(), self.records[-1].milestoneTo ]
-            coors.append ( coor )
-
-        #debug('coors: %s' % coors )
-
-        # sort by measure
-        coors.sort(key = lambda x: x[2])
+            milestoneCoors.append( [ point.x(), point.y(), self.records[-1].milestoneTo ] )
+
+        # merge by measure, vertex first if measures are equal,
+        # skip coordinates too close to previous
+        i = j = 0
+        previous = None
+        while i < len(vertexCoors) or j < len(milestoneCoors):
+            if j == len(milestoneCoors) or ( i < len(vertexCoors) and vertexCoors[i][2] <= milestoneCoors[j][2] ):
+                coor = vertexCoors[i]
+                i += 1
+            else:
+                coor = milestoneCoors[j]
+                j += 1
 
-        # remove coordinates too close each other
-        for i in range(len(coors)-1,0,-1):
-            if doubleNear( coors[i][2], coors[i-1][2] ):
-                del coors[i]
+            if previous is None or not doubleNear( coor[2], previous[2] ):
+                coors.append( coor )
+            previous = coor
 
+        #debug('coors: %s' % coors )
         return coors
 
     def getWktWithMeasures(self):
@@ -26,7 +26,10 @@ from qgis.core import *
 
 from utils import *
 
+# There may be millions of points, geometry is kept as WKB which is much
+# smaller than QgsGeometry
 class LrsPoint(object):
+    __slots__ = ( 'fid', 'routeId', 'measure', 'wkb' )
 
     def __init__(self, fid, routeId, measure, geo ):
         self.fid = fid # point feature id
@@ -35,14 +38,33 @@ class LrsPoint(object):
         if self.measure is not None:
             self.measure = float( self.measure )
         #debug ( "routeId = %s %s measure = %s %s" % (routeId, type(routeId), measure, type(measure) ) )
-        # original feature geo, may be multipart
-        self.geo = QgsGeometry(geo) # store copy of QgsGeometry
+        # original feature geo WKB, may be multipart, None if geo is None
+        self.wkb = geo.asWkb() if geo else None
+
+    # original feature geometry, new QgsGeometry is created on each call
+    @property
+    def geo(self):
+        if self.wkb is None: return None
+        return geometryFromWkb( self.wkb )
 
     def getNumParts(self):
-        if not self.geo: return 0
+        geo = self.geo
+        if not geo: return 0
         
-        if self.geo.isMultipart():
-            return len( self.geo.asMultiPoint() )
+        if geo.isMultipart():
+            return len( geo.asMultiPoint() )
 
         return 1
 
+    # returns list of QgsPoint of all geometry parts
+    def getPoints(self):
+        geo = self.geo
+        if not geo: return []
+
+        if geo.wkbType() in [ QGis.WKBPoint, QGis.WKBPoint25D]:
+            return [ geo.asPoint() ]
+        elif geo.wkbType() in [ QGis.WKBMultiPoint, QGis.WKBMultiPoint25D]: 
+            # multi (makes little sense)
+            return geo.asMultiPoint()
+        return []
+
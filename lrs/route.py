@@ -19,7 +19,8 @@
  *                                                                         *
  ***************************************************************************/
 """
-import sys, operator, math
+import sys, operator, math, heapq
+from functools import partial
 # Import the PyQt and QGIS libraries
 from PyQt4.QtCore import *
 #from PyQt4.QtGui import *
@@ -30,6 +31,8 @@ from part import *
 from error import *
 from point import *
 from milestone import *
+from graph import *
+from index import *
 
 # LrsRoute keeps list of LrsLine 
 
@@ -55,6 +58,10 @@ class LrsRoute:
         self.errors = [] # LrsError list of route errors
         # cached all errors, route itself and parts
         self.allErrors_ = [] 
+        # cached LrsMeasureIndex of parts records
+        self.measureIndex_ = None
+        # cached checksums of quality features
+        self.qualityChecksums_ = None
 
     def addLine( self, line ):
         self.lines.append( line )
@@ -66,33 +73,35 @@ class LrsRoute:
         self.milestones = []
         self.errors = []
         self.allErrors_ = []
+        self.measureIndex_ = None
+        self.qualityChecksums_ = None
 
         if self.routeId == None: # special case 
             for line in self.lines:
-                if not line.geo: continue
+                if line.wkb is None: continue
                 origin = LrsOrigin( QGis.Line, line.fid )
-                self.errors.append( LrsError( LrsError.NO_ROUTE_ID, line.geo, origins = [ origin ] ) )  
+                self.errors.append( LrsError( LrsError.NO_ROUTE_ID, partial( geometryFromWkb, line.wkb ), origins = [ origin ] ) )  
 
             for point in self.points:
-                if not point.geo: continue
+                if point.wkb is None: continue
                 origin = LrsOrigin( QGis.Point, point.fid )
-                self.errors.append( LrsError( LrsError.NO_ROUTE_ID, point.geo, origins = [ origin ] ) )  
+                self.errors.append( LrsError( LrsError.NO_ROUTE_ID, partial( geometryFromWkb, point.wkb ), origins = [ origin ] ) )  
 
                 # in addition it may be without measure
                 if point.measure == None:
                     origin = LrsOrigin( QGis.Point, point.fid )
-                    self.errors.append( LrsError( LrsError.NO_MEASURE, point.geo, origins = [ origin ] ) )
+                    self.errors.append( LrsError( LrsError.NO_MEASURE, partial( geometryFromWkb, point.wkb ), origins = [ origin ] ) )
 
         elif len( self.lines ) == 0: # no lines -> orphan points
             for point in self.points:
-                if not point.geo: continue
+                if point.wkb is None: continue
                 origin = LrsOrigin( QGis.Point, point.fid )
-                self.errors.append( LrsError( LrsError.ORPHAN, point.geo, routeId = self.routeId, measure = point.measure, origins = [ origin ] ) )
+                self.errors.append( LrsError( LrsError.ORPHAN, partial( geometryFromWkb, point.wkb ), routeId = self.routeId, measure = point.measure, origins = [ origin ] ) )
 
                 # in addition it may be without measure
                 if point.measure == None:
                     origin = LrsOrigin( QGis.Point, point.fid )
-                    self.errors.append( LrsError( LrsError.NO_MEASURE, point.geo, routeId = self.routeId, origins = [ origin ] ) )
+                    self.errors.append( LrsError( LrsError.NO_MEASURE, partial( geometryFromWkb, point.wkb ), routeId = self.routeId, origins = [ origin ] ) )
 
         else:
             self.buildParts()
@@ -103,14 +112,53 @@ class LrsRoute:
                 self.extrapolateParts()
             self.checkPartOverlaps()
 
+    # Calibration results as plain picklable data, used to get calibrated route
+    # back from worker process, see Lrs.calibrateRoutesParallel()
+    def getCalibrationState(self):
+        milestoneIndices = {} # id(milestone): index
+        milestones = []
+        for i in range( len(self.milestones) ):
+            m = self.milestones[i]
+            milestoneIndices[id(m)] = i
+            milestones.append( ( m.fid, m.geoPart, m.nGeoParts, m.pnt.x(), m.pnt.y(), m.measure, m.partIdx, m.partMeasure ) )
+
+        return {
+            'milestones': milestones,
+            'parts': [ part.getCalibrationState( milestoneIndices ) for part in self.parts ],
+            'errors': [ error.getState() for error in self.errors ],
+        }
+
+    # restore calibration results from getCalibrationState() data
+    def setCalibrationState(self, state):
+        self.milestones = []
+        for fid, geoPart, nGeoParts, x, y, measure, partIdx, partMeasure in state['milestones']:
+            milestone = LrsMilestone( fid, geoPart, nGeoParts, QgsPoint( x, y ), measure )
+            milestone.partIdx = partIdx
+            milestone.partMeasure = partMeasure
+            self.milestones.append( milestone )
+
+        self.parts = []
+        for partState in state['parts']:
+            polyline = [ QgsPoint( x, y ) for x, y in partState['polyline'] ]
+            origins = [ LrsOrigin( *origin ) for origin in partState['origins'] ]
+            part = LrsRoutePart( polyline, self.routeId, origins, self.crs, self.measureUnit, self.distanceArea )
+            part.setCalibrationState( partState, self.milestones )
+            self.parts.append( part )
+
+        self.errors = [ LrsError.fromState( error ) for error in state['errors'] ]
+        self.allErrors_ = []
+        self.measureIndex_ = None
+        self.qualityChecksums_ = None
+
     def calibrateAndGetUpdates(self, extrapolate):
         oldErrorChecksums = list( e.getChecksum() for e in self.getErrors() )
-        oldQualityChecksums = list( e.getChecksum() for e in self.getQualityFeatures() )
+        oldQualityChecksums = self.getQualityChecksums()
 
         self.calibrate(extrapolate)
 
         newErrors = self.getErrors() 
-        newErrorChecksums = list( e.getChecksum() for e in newErrors )
+        newErrorChecksums = set( e.getChecksum() for e in newErrors )
+        oldErrorChecksumsSet = set( oldErrorChecksums )
         addedErrors = []
         updatedErrors = []
         removedErrorChecksums = []
@@ -119,7 +167,7 @@ class LrsRoute:
                 #debug ( 'removed error' )
                 removedErrorChecksums.append( checksum )
         for error in newErrors:
-            if error.getChecksum() in oldErrorChecksums:
+            if error.getChecksum() in oldErrorChecksumsSet:
                 #debug ( 'updated error' )
                 updatedErrors.append ( error )
             else:
@@ -128,14 +176,16 @@ class LrsRoute:
 
         # simple remove and add for quality
         newQualityFeatures = self.getQualityFeatures() 
-        newQualityChecksums = list ( f.getChecksum() for f in newQualityFeatures )
+        self.qualityChecksums_ = list ( f.getChecksum() for f in newQualityFeatures )
+        newQualityChecksums = set( self.qualityChecksums_ )
+        oldQualityChecksumsSet = set( oldQualityChecksums )
         addedQualityFeatures = []
         removedQualityChecksums = []
         for checksum in oldQualityChecksums:
             if not checksum in newQualityChecksums:
                 removedQualityChecksums.append( checksum )
         for feature in newQualityFeatures:
-            if not feature.getChecksum() in oldQualityChecksums:
+            if not feature.getChecksum() in oldQualityChecksumsSet:
                 addedQualityFeatures.append( feature )
 
         return { 'removedErrorChecksums': removedErrorChecksums,
@@ -144,66 +194,18 @@ class LrsRoute:
                  'removedQualityChecksums': removedQualityChecksums,
                  'addedQualityFeatures': addedQualityFeatures }
 
-    def getPartsNodes(self, parts):
-        nodes = {} 
-        for part in parts:
-            for i in [0,-1]:    
-                ph = pointHash( part.polyline[i] )
-                if not nodes.has_key( ph ):
-                    nodes[ ph ] = { 'pnt': part.polyline[i], 'parts': [ part ] }
-                else:
-                    nodes[ ph ]['parts'].append( part ) 
-        return nodes
- 
+    # join parts connected without fork
     def joinParts(self, parts):
         #debug ( 'join %s parts' % ( len(parts)) )
-        nodes = self.getPartsNodes( parts )
+        graph = LrsGraph( [ part.polyline for part in parts ] )
         joined = []
-        while len(parts) > 0:
-            part1 = parts.pop(0)
+        for polyline, indices in graph.getChains():
+            part1 = parts[ indices[0] ]
+            if len( indices ) > 1:
+                part1.setPolyline ( polyline )
+                for idx in indices[1:]:
+                    part1.origins.extend( parts[idx].origins )
             joined.append ( part1 )
-            polyline = part1.polyline
-            while True:
-                connected = False
-                for part2 in parts:
-                    polyline2 = part2.polyline
-
-                    forks2 = [False, False]
-                    for j in [0, -1]:
-                        ph = pointHash( polyline2[j] )
-                        node = nodes[ph]
-                        if len(node['parts']) > 2:
-                            forks2[j] = True
-
-                    if polyline[-1] == polyline2[0] and not forks2[0]: # --1-->  --2-->
-                        del polyline2[0]
-                        polyline.extend(polyline2)
-                        connected = True
-                    elif polyline[-1] == polyline2[-1] and not forks2[-1]: # --1--> <--2--
-                        polyline2.reverse()
-                        del polyline2[0]
-                        polyline.extend(polyline2)
-                        connected = True
-                    elif polyline[0] == polyline2[-1] and not forks2[-1]: # --2--> --1-->
-                        del polyline[0]
-                        polyline2.extend(polyline)
-                        polyline = polyline2
-                        connected = True
-                    elif polyline[0] == polyline2[0] and not forks2[0]: # <--2-- --1-->
-                        polyline2.reverse()
-                        del polyline[0]
-                        polyline2.extend(polyline)
-                        polyline = polyline2
-                        connected = True
-
-                    if connected: 
-                        part1.setPolyline ( polyline )
-                        part1.origins.extend( part2.origins )
-                        parts.remove( part2 )
-                        break
-
-                if not connected: # no more parts can be connected
-                    break
         #debug ( 'joined to %s parts' % ( len(joined)))
         return joined
 
@@ -213,15 +215,8 @@ class LrsRoute:
         self.parts = []
         polylines = [] # list of { polyline:, fid:, geoPart:, nGeoParts: }
         for line in self.lines:
-            if not line.geo: continue
-            # QGis::singleType and flatType are not in bindings (2.0)
-            polys = None # list of QgsPolyline
-            if line.geo.wkbType() in [ QGis.WKBLineString, QGis.WKBLineString25D]:
-                #polylines.append( line.geo.asPolyline() )
-                polys = [ line.geo.asPolyline() ]
-            elif line.geo.wkbType() in [ QGis.WKBMultiLineString, QGis.WKBMultiLineString25D]:
-                #polylines.extend ( line.geo.asMultiPolyline() )
-                polys = line.geo.asMultiPolyline()
+            if line.wkb is None: continue
+            polys = line.getPolylines() # list of QgsPolyline
 
             for i in range(len(polys)):
                 poly = polys[i]
@@ -248,120 +243,70 @@ class LrsRoute:
 
         ##### snap ends
         if self.snap > 0:
+            # ends indexed by ( polyline index, coor index )
+            grid = LrsPointGrid( self.snap )
+            for i in range(len(polylines)):
+                p1 = polylines[i]['polyline']
+                for ic in [0,-1]:
+                    grid.insert( ( i, ic ), p1[ic] )
+
             for i in range(len(polylines)):
                 p1 = polylines[i]['polyline']
                 # indexed by coor index:
-                snapped = { 0: False, -1: False } 
                 nearest = { 0: None, -1: None }
-                nearest_dist = { 0: sys.float_info.max, -1: sys.float_info.max }
-                for j in range(len(polylines)):
-                    if j == i: continue
-                    p2 = polylines[j]['polyline']
-                    #debug ( '%s x %s' % (p1,p2) )
-                    for ic in [0,-1]:
-                        if not snapped[ic]:
-                            if p1[ic] == p2[0] or p1[ic] == p2[-1]:
-                                snapped[ic] = True
-                            else:
-                                for jc in [0,-1]:
-                                    d = pointsDistance(p1[ic], p2[jc])
-                                    if d <= self.snap and d < nearest_dist[ic]:
-                                        nearest[ic] = [j,jc]
-                                        nearest_dist[ic] = d
+                for ic in [0,-1]:
+                    snapped = False
+                    nearestKey = None # ( distance, polyline index, 0 for start / 1 for end ) 
+                    for ( j, jc ), pnt in grid.neighbours( p1[ic] ):
+                        if j == i: continue
+                        if p1[ic] == pnt:
+                            snapped = True
+                            break
+                        d = pointsDistance( p1[ic], pnt )
+                        # the first nearest in order of polylines and their ends is used 
+                        key = ( d, j, 0 if jc == 0 else 1 )
+                        if d <= self.snap and ( nearestKey is None or key < nearestKey ):
+                            nearest[ic] = [j,jc]
+                            nearestKey = key
+                    if snapped:
+                        nearest[ic] = None
                 # snap if not yet snapped and nearest found
                 for ic in [0,-1]:
-                    if not snapped[ic] and nearest[ic] is not None:
+                    if nearest[ic] is not None:
                         p2 = polylines[ nearest[ic][0] ]['polyline']
+                        grid.remove( ( i, ic ), p1[ic] )
                         p1[ic] = p2[ nearest[ic][1] ]
-            
+                        grid.insert( ( i, ic ), p1[ic] )
 
         ##### check for duplicates
-        duplicates = set()
-        for i in range(len(polylines)-1):
-            for j in range(i+1,len(polylines)):
-                if polylinesIdentical( polylines[i]['polyline'], polylines[j]['polyline'] ):
-                    #debug( 'identical polylines %d and %d' % (i, j) )
-                    duplicates.add(j)
-        # make reverse ordered unique list of duplicates and delete
-        duplicates = list( duplicates )
-        duplicates.sort(reverse=True)
+        # polylines are compared only with polylines with the same fingerprint
+        duplicates = []
+        uniques = {} # fingerprint: list of indices of unique polylines
+        for i in range(len(polylines)):
+            polyline = polylines[i]['polyline']
+            bucket = uniques.setdefault( polylineFingerprint( polyline ), [] )
+            for j in bucket:
+                if polylinesIdentical( polylines[j]['polyline'], polyline ):
+                    #debug( 'identical polylines %d and %d' % (j, i) )
+                    duplicates.append( i )
+                    break
+            else:
+                bucket.append( i )
+        # make reverse ordered list of duplicates and delete
+        duplicates.reverse()
         for d in duplicates: # delete going down (sorted reverse)
-            geo = QgsGeometry.fromPolyline( polylines[d]['polyline'] )
+            geo = partial( QgsGeometry.fromPolyline, polylines[d]['polyline'] )
             origin = LrsOrigin( QGis.Line, polylines[d]['fid'], polylines[d]['geoPart'], polylines[d]['nGeoParts'] )
             self.errors.append( LrsError( LrsError.DUPLICATE_LINE, geo, routeId = self.routeId, origins = [ origin ] ) )
             del  polylines[d]
              
-        ###### find forks
-        nodes = {} 
-        for poly in polylines:
-            polyline = poly['polyline']
-            for i in [0,-1]:    
-                ph = pointHash( polyline[i] )
-                if not nodes.has_key( ph ):
-                    nodes[ ph ] = { 'pnt': polyline[i], 'nlines': 1 }
-                else:
-                    nodes[ ph ]['nlines'] += 1 
-
-        # moved to parallels block
-        #for node in nodes.values():
-        #    #debug( "nlines = %s" % node['nlines'] )
-        #    if node['nlines'] > 2:
-        #        geo = QgsGeometry.fromPoint( node['pnt'] )
-        #        # origins sould not be necessary
-        #        self.errors.append( LrsError( LrsError.FORK, geo, routeId = self.routeId ) )    
-
         ###### join polylines to parts
-        # TODO: similar code as joinParts, use common function
-        while len( polylines ) > 0:
-            #polyline = polylines.pop(0)
-            poly = polylines.pop(0)
-            polyline = poly['polyline']
-            origin = LrsOrigin( QGis.Line, poly['fid'], poly['geoPart'], poly['nGeoParts'] )
-            origins = [ origin ]
-            while True: # connect parts
-                connected = False
-                for i in range(len( polylines )):
-                    #polyline2 = polylines[i]
-                    poly2 = polylines[i]
-                    polyline2 = poly2['polyline']
-
-                    # dont connect in forks (we don't know which is better)
-                    forks2 = [False, False]
-                    for j in [0, -1]:
-                        ph = pointHash( polyline2[j] )
-                        if nodes[ph]['nlines'] > 2:
-                            forks2[j] = True
-
-                    if polyline[-1] == polyline2[0] and not forks2[0]: # --1-->  --2-->
-                        del polyline2[0]
-                        polyline.extend(polyline2)
-                        connected = True
-                    elif polyline[-1] == polyline2[-1] and not forks2[-1]: # --1--> <--2--
-                        polyline2.reverse()
-                        del polyline2[0]
-                        polyline.extend(polyline2)
-                        connected = True
-                    elif polyline[0] == polyline2[-1] and not forks2[-1]: # --2--> --1-->
-                        del polyline[0]
-                        polyline2.extend(polyline)
-                        polyline = polyline2
-                        connected = True
-                    elif polyline[0] == polyline2[0] and not forks2[0]: # <--2-- --1-->
-                        polyline2.reverse()
-                        del polyline[0]
-                        polyline2.extend(polyline)
-                        polyline = polyline2
-                        connected = True
-
-                    if connected: 
-                        #print '%s part connected' % i
-                        origin = LrsOrigin( QGis.Line, polylines[i]['fid'], polylines[i]['geoPart'], polylines[i]['nGeoParts'] )
-                        origins.append( origin )
-                        del polylines[i]
-                        break
-
-                if not connected: # no more parts can be connected
-                    break
+        graph = LrsGraph( [ poly['polyline'] for poly in polylines ] )
+        for polyline, indices in graph.getChains():
+            origins = []
+            for idx in indices:
+                poly = polylines[idx]
+                origins.append( LrsOrigin( QGis.Line, poly['fid'], poly['geoPart'], poly['nGeoParts'] ) )
 
             part = LrsRoutePart( polyline, self.routeId, origins, self.crs, self.measureUnit, self.distanceArea)
             if part.length > 0:
@@ -372,43 +317,29 @@ class LrsRoute:
 
         #debug ( 'num parts = %s' % len(self.parts) )
         # Find loops
-        parallelParts = []
-        for i in range(len(self.parts)):
-            part1 = self.parts[i]
-            if parallelParts and part1 in reduce(operator.add, parallelParts): # already in parallels
-                continue
-
-            poly1 = part1.polyline
-            parallels = []
-            for j in range(len(self.parts)):
-                if j == i: continue
-                part2 = self.parts[j]
-                poly2 = part2.polyline
-                if (poly1[0] == poly2[0] and poly1[-1] == poly2[-1]) or (poly1[0] == poly2[-1] and poly1[-1] == poly2[0]):
-                    parallels.append( part2 )
-
-            if parallels:
-                parallels.insert(0, part1 )
-                parallelParts.append( parallels )
+        graph = LrsGraph( [ part.polyline for part in self.parts ] )
+        parallelParts = [ [ self.parts[idx] for idx in indices ] for indices in graph.getParallels() ]
 
         #if parallelParts:
         #    debug ( 'routeId %s parallelParts: %s' % (self.routeId, parallelParts ))
 
+        removed = set() # ids of removed parts
+        spanParts = []
         for parallels in parallelParts:
             origins = []
             for part in parallels:
                 origins.extend ( part.origins )
                 if self.parallelMode == 'error':
-                    geo = QgsGeometry.fromPolyline( part.polyline )
+                    geo = partial( QgsGeometry.fromPolyline, part.polyline )
                     self.errors.append( LrsError( LrsError.PARALLEL, geo, routeId = self.routeId, origins = part.origins ) )
 
-                self.parts.remove( part )
+                removed.add( id( part ) )
 
             # forks
             if self.parallelMode == 'error':
                 part = parallels[0]
                 for i in [0, -1]:
-                    geo = QgsGeometry.fromPoint( part.polyline[i] )
+                    geo = partial( QgsGeometry.fromPoint, part.polyline[i] )
                     # origins sould not be necessary
                     self.errors.append( LrsError( LrsError.FORK, geo, routeId = self.routeId ) )    
 
@@ -416,33 +347,38 @@ class LrsRoute:
                 part = parallels[0]
                 polyline = [ part.polyline[0], part.polyline[-1] ]
                 
-                self.parts.append( LrsRoutePart( polyline, self.routeId, origins, self.crs, self.measureUnit, self.distanceArea) )
+                spanParts.append( LrsRoutePart( polyline, self.routeId, origins, self.crs, self.measureUnit, self.distanceArea) )
+
+        if parallelParts:
+            self.parts = [ part for part in self.parts if id( part ) not in removed ]
+            self.parts.extend( spanParts )
 
         # reconnect parts after parallels span
         if parallelParts and self.parallelMode == 'span':
             self.parts = self.joinParts( self.parts )
 
         # identify true forks (not parallels)
-        nodes = self.getPartsNodes( self.parts )
+        graph = LrsGraph( [ part.polyline for part in self.parts ] )
+        forks = graph.getForks()
 
-        for node in nodes.values():
-            if len(node['parts']) > 2:
-                geo = QgsGeometry.fromPoint( node['pnt'] )
-                self.errors.append( LrsError( LrsError.FORK, geo, routeId = self.routeId ) )    
+        for pnt, indices in forks:
+            geo = partial( QgsGeometry.fromPoint, pnt )
+            self.errors.append( LrsError( LrsError.FORK, geo, routeId = self.routeId ) )    
         # mark shortest forked parts as errors
-        for ph, node in nodes.iteritems():
-            parts = node['parts']
-            if len(parts) <= 2: continue
-            
-            parts.sort(key=lambda part: part.length)
-
-            removeParts = parts[0:len(parts)-2]
-            for part in removeParts:
+        removed = set() # indices of removed parts
+        for pnt, indices in forks:
+            # sort is stable, the first of parts with the same length is removed
+            indices.sort(key=lambda idx: self.parts[idx].length)
+
+            removeIndices = indices[0:len(indices)-2]
+            for idx in removeIndices:
                 # one part may be fork at both ends -> check if it was already removed
-                if part in self.parts:
-                    geo = QgsGeometry.fromPolyline( part.polyline )
+                if idx not in removed:
+                    part = self.parts[idx]
+                    geo = partial( QgsGeometry.fromPolyline, part.polyline )
                     self.errors.append( LrsError( LrsError.FORK_LINE, geo, routeId = self.routeId, origins = part.origins ) )
-                    self.parts.remove(part)
+                    removed.add( idx )
+        self.parts = [ self.parts[i] for i in range( len(self.parts) ) if i not in removed ]
 
         # join again after forks removed
         self.parts = self.joinParts( self.parts )
@@ -469,19 +405,14 @@ class LrsRoute:
         # TODO: maybe allow duplicates? Could be end/start of discontinuous segments
         nodes = {} 
         for point in self.points:
-            if not point.geo: continue
+            if point.wkb is None: continue
 
             if point.measure == None:
                 origin = LrsOrigin( QGis.Point, point.fid )
-                self.errors.append( LrsError( LrsError.NO_MEASURE, point.geo, routeId = self.routeId, origins = [ origin ] ) )
+                self.errors.append( LrsError( LrsError.NO_MEASURE, partial( geometryFromWkb, point.wkb ), routeId = self.routeId, origins = [ origin ] ) )
                 continue
 
-            pts = []
-            if point.geo.wkbType() in [ QGis.WKBPoint, QGis.WKBPoint25D]:
-                pts = [ point.geo.asPoint() ]
-            elif point.geo.wkbType() in [ QGis.WKBMultiPoint, QGis.WKBMultiPoint25D]: 
-                # multi (makes little sense)
-                pts = point.geo.asMultiPoint()
+            pts = point.getPoints()
 
             pnts = [] # list of { point:, geoPart: }
             for i in range(len(pts)):
@@ -489,12 +420,12 @@ class LrsRoute:
 
             for p in pnts:
                 pnt = p['point']
-                ph = pointHash( pnt )
+                key = pointKey( pnt )
 
                 origin = LrsOrigin( QGis.Point, point.fid, p['geoPart'], p['nGeoParts'] )
         
-                if not nodes.has_key( ph ):
-                    nodes[ ph ] = { 
+                if not nodes.has_key( key ):
+                    nodes[ key ] = { 
                         'pnt': pnt, 
                         'npoints': 1, 
                         'measures': [ point.measure ], 
@@ -503,16 +434,16 @@ class LrsRoute:
                         'origins': [ origin ] 
                     }
                 else:
-                    nodes[ ph ]['npoints'] += 1 
-                    nodes[ ph ]['measures'].append( point.measure )
-                    #nodes[ ph ]['fids'].append( point.fid )
-                    #nodes[ ph ]['geoPart'].append( ['geoPart'] )
-                    nodes[ ph ]['origins'].append( origin )
+                    nodes[ key ]['npoints'] += 1 
+                    nodes[ key ]['measures'].append( point.measure )
+                    #nodes[ key ]['fids'].append( point.fid )
+                    #nodes[ key ]['geoPart'].append( ['geoPart'] )
+                    nodes[ key ]['origins'].append( origin )
 
         for node in nodes.values():
             #debug ( "npoints = %s" % node['npoints'] )
             if node['npoints'] > 1:
-                geo = QgsGeometry.fromPoint( node['pnt'] )
+                geo = partial( QgsGeometry.fromPoint, node['pnt'] )
                 self.errors.append( LrsError( LrsError.DUPLICATE_POINT, geo, routeId = self.routeId, measure = node['measures'], origins = node['origins'] ) )    
     
             measure = node['measures'][0] # first if duplicates, for now
@@ -522,36 +453,20 @@ class LrsRoute:
     def attachMilestones(self):
         if not self.routeId: return 
 
-        sqrThreshold = self.threshold * self.threshold
+        segmentIndex = LrsSegmentIndex( [ part.polyline for part in self.parts ] )
         for milestone in self.milestones:
-            pointGeo = QgsGeometry.fromPoint( milestone.pnt )
-
-            nearSqDist = sys.float_info.max
-            nearPartIdx = None
-            nearSegment = None
-            nearNearestPnt = None 
-            for i in range( len(self.parts) ):
-                part = self.parts[i]
-                partGeo = QgsGeometry.fromPolyline( part.polyline )
-
-                ( sqDist, nearestPnt, afterVertex ) = partGeo.closestSegmentWithContext( milestone.pnt )
-                segment = afterVertex-1
-                #debug ('sqDist %s x %s' % (sqDist, sqrThreshold) )
-                if sqDist <= sqrThreshold and sqDist < nearSqDist:
-                    nearSqDist = sqDist
-                    nearPartIdx = i
-                    nearSegment = segment
-                    nearNearestPnt = nearestPnt
-
-            #debug ('nearest partIdx = %s segment = %s sqDist = %s' % ( nearPartIdx, nearSegment, nearSqDist) )
-            if nearNearestPnt: # found part in threshold
+            nearest = segmentIndex.nearestSegment( milestone.pnt, self.threshold )
+            if nearest: # found part in threshold
+                ( nearSqDist, nearPartIdx, nearSegment, nearNearestPnt ) = nearest
+                #debug ('nearest partIdx = %s segment = %s sqDist = %s' % ( nearPartIdx, nearSegment, nearSqDist) )
                 milestone.partIdx = nearPartIdx
                 nearPart = self.parts[nearPartIdx]
-                milestone.partMeasure = measureAlongPolyline( nearPart.polyline, nearSegment, nearNearestPnt )
+                milestone.partMeasure = measureAlongPolyline( nearPart.polyline, nearSegment, nearNearestPnt, nearPart.getDistances() )
 
                 nearPart.milestones.append( milestone )
             else:   
                 origin = LrsOrigin( QGis.Point, milestone.fid, milestone.geoPart, milestone.nGeoParts )
+                pointGeo = partial( QgsGeometry.fromPoint, milestone.pnt )
                 self.errors.append( LrsError( LrsError.OUTSIDE_THRESHOLD, pointGeo, routeId = self.routeId, measure = milestone.measure, origins = [ origin ] ) )    
                  
     def calibrateParts(self):
@@ -564,22 +479,40 @@ class LrsRoute:
 
     def checkPartOverlaps(self):
         records = []
-        overlaps = set()
         recordParts = {}
         for part in self.parts:
             for record in part.getRecords():
                 records.append( record )
                 recordParts[record] = part
-        for record in records:
-            for record2 in records:
-                if record2 is record: continue
+
+        # Sweep records sorted by lower measure, active are records whose measure 
+        # range contains current lower measure, only those may overlap.
+        # Ranges are closed to get also candidates for degenerated records, 
+        # candidates are verified by measureOverlaps.
+        overlapping = set() # indices of overlapping records
+        ranges = [] # [ lower measure, upper measure, record index ]
+        for i in range( len(records) ):
+            record = records[i]
+            ranges.append( [ min( record.milestoneFrom, record.milestoneTo ), max( record.milestoneFrom, record.milestoneTo ), i ] )
+        ranges.sort()
+        active = [] # heap of [ upper measure, record index ]
+        for lower, upper, i in ranges:
+            while active and active[0][0] < lower:
+                heapq.heappop( active )
+            record = records[i]
+            for upper2, j in active:
+                record2 = records[j]
                 if record.measureOverlaps( record2 ):
-                    overlaps.add( record )
+                    overlapping.add( i )
+                if record2.measureOverlaps( record ):
+                    overlapping.add( j )
+            heapq.heappush( active, [ upper, i ] )
+        overlaps = [ records[i] for i in sorted( overlapping ) ]
 
         #debug("overlaps: %s" % overlaps )
         for record in overlaps:
             part = recordParts[record]
-            geo = part.getRecordGeometry(record)
+            geo = partial( part.getRecordGeometry, record )
             measureFrom = formatMeasure(record.milestoneFrom, self.measureUnit)
             measureTo = formatMeasure(record.milestoneTo, self.measureUnit)
             self.errors.append( LrsError( LrsError.DUPLICATE_REFERENCING, geo, routeId = self.routeId, measure = [ measureFrom, measureTo ] ) )
@@ -607,13 +540,12 @@ class LrsRoute:
 
     def getQualityFeatures(self):
         features = [] 
-        fields = LrsQualityFields()
+        qgisUnit = QGis.Meters if self.distanceArea.ellipsoidalEnabled() else self.crs.mapUnits()
         for segment in self.getSegments():
             #m_len = self.mapUnitsPerMeasureUnit * (segment.record.milestoneTo - segment.record.milestoneFrom)
             m_len = segment.record.milestoneTo - segment.record.milestoneFrom
             #length = segment.geo.length()
             length = self.distanceArea.measure( segment.geo )
-            qgisUnit = QGis.Meters if self.distanceArea.ellipsoidalEnabled() else self.crs.mapUnits()
             length = convertDistanceUnits( length, qgisUnit, self.measureUnit )
             err_abs = m_len - length
             err_rel = err_abs / length if length > 0 else 0
@@ -631,6 +563,13 @@ class LrsRoute:
 
         return features
 
+    # checksums of quality features, features are not kept because they may 
+    # be modified (transformed) when added to layer
+    def getQualityChecksums(self):
+        if self.qualityChecksums_ is None:
+            self.qualityChecksums_ = list ( f.getChecksum() for f in self.getQualityFeatures() )
+        return self.qualityChecksums_
+
     def getGoodMilestones(self):
         goodMilestones = []
         for part in self.parts:
@@ -645,40 +584,114 @@ class LrsRoute:
         return length
 
     # returns ( QgsPoint, error )
+    def getMeasureIndex(self):
+        if not self.measureIndex_:
+            self.measureIndex_ = LrsMeasureIndex( self.parts )
+        return self.measureIndex_
+
     def eventPoint(self, start, tolerance=0):
-        for part in self.parts:
-            point = part.eventPoint( start )
-            if point: return point, None
+        index = self.getMeasureIndex()
+        if start is not None:
+            # the first record containing measure in each part
+            measure = float( start )
+            searched = set() # part indices
+            for partIdx, recordIdx in index.intersects( measure, measure ):
+                if partIdx in searched: continue
+                searched.add( partIdx )
+                part = self.parts[partIdx]
+                point = part.recordPoint( part.records[recordIdx], measure )
+                if point: return point, None
 
         # second try with tolerance
         if tolerance > 0:
             nearestPoint = None
-            nearestMeasure = sys.float_info.max
-            for part in self.parts:
-                for record in part.records:
-                    m = abs(record.milestoneFrom-start)
-                    if m <= tolerance and m < nearestMeasure:
-                        nearestPoint = part.eventPoint( record.milestoneFrom )
-                        nearestMeasure = m
-
-                    m = abs(record.milestoneTo-start)
-                    if m <= tolerance and m < nearestMeasure:
-                        nearestPoint = part.eventPoint( record.milestoneTo )
-                        nearestMeasure = m
+            nearest = index.nearestEnd( start, tolerance )
+            if nearest:
+                measure, partIdx = nearest
+                nearestPoint = self.parts[partIdx].eventPoint( measure )
  
             if nearestPoint: return nearestPoint, None
 
         return None, 'measure not available'
 
+    # batch version of eventPoint, starts must not be None
+    # returns ( list of QgsPoint or None, list of errors or None )
+    def eventPoints(self, starts, tolerance=0):
+        points = [ None ] * len(starts)
+        errors = [ None ] * len(starts)
+        measures = [ float( start ) for start in starts ]
+        index = self.getMeasureIndex()
+
+        # points are interpolated for each part at once on the first record 
+        # containing the measure in the first part
+        partEvents = {} # part index: [ [ event index, record index ], ... ]
+        for i in sorted( range(len(measures)), key = lambda i: measures[i] ):
+            found = index.intersects( measures[i], measures[i] )
+            if found:
+                partIdx, recordIdx = found[0]
+                partEvents.setdefault( partIdx, [] ).append( [ i, recordIdx ] )
+
+        for partIdx, events in partEvents.iteritems():
+            part = self.parts[partIdx]
+            partPoints = part.recordPoints( [ event[1] for event in events ], [ measures[event[0]] for event in events ] )
+            for j in range(len(events)):
+                points[ events[j][0] ] = partPoints[j]
+
+        # events not found above are searched in other parts and with tolerance
+        for i in range(len(starts)):
+            if not points[i]:
+                points[i], errors[i] = self.eventPoint( starts[i], tolerance )
+
+        return points, errors
+
+    # batch version of eventMultiPolyLine, starts and ends must not be None
+    # returns ( list of QgsMultiPolyline or None, list of errors or None )
+    def eventMultiPolyLines(self, starts, ends, tolerance=0):
+        # events sorted by start are grouped by parts with the first record
+        # intersecting event in each part, segments are cut part by part 
+        partEvents = {} # part index: [ [ event index, first record index ], ... ]
+        for i in sorted( range(len(starts)), key = lambda i: float( starts[i] ) ):
+            for partIdx, recordIdx in self.eventFirstRecords( starts[i], ends[i] ).iteritems():
+                partEvents.setdefault( partIdx, [] ).append( [ i, recordIdx ] )
+
+        segments = [ [] for i in range(len(starts)) ] # [ [ QgsPolyline, measure_from, measure_to ], ... ]
+        for partIdx in sorted( partEvents.keys() ):
+            part = self.parts[partIdx]
+            for i, recordIdx in partEvents[partIdx]:
+                segments[i].extend( part.eventSegments( starts[i], ends[i], recordIdx ) )
+
+        multipolylines = [ None ] * len(starts)
+        errors = [ None ] * len(starts)
+        for i in range(len(starts)):
+            multipolylines[i], errors[i] = self.segmentsMultiPolyLine( segments[i], starts[i], ends[i], tolerance )
+        return multipolylines, errors
+
+    # returns { part index: index of the first record intersecting event }
+    def eventFirstRecords(self, start, end):
+        firstRecords = {}
+        for partIdx, recordIdx in self.getMeasureIndex().intersects( float(start), float(end) ):
+            if not firstRecords.has_key( partIdx ):
+                # eventSegments stops after the first record if start and end are equal 
+                firstRecords[partIdx] = 0 if doubleNear( float(start), float(end) ) else recordIdx
+        return firstRecords
+
     # returns ( QgsMultiPolyline, error )
     def eventMultiPolyLine(self, start, end, tolerance=0):
+        segments = []
+        if start is not None and end is not None:
+            firstRecords = self.eventFirstRecords( start, end )
+            for partIdx in sorted( firstRecords.keys() ):
+                segments.extend( self.parts[partIdx].eventSegments( start, end, firstRecords[partIdx] ) )
+        return self.segmentsMultiPolyLine( segments, start, end, tolerance )
+
+    # segments: [ [ QgsPolyline, measure_from, measure_to ], ... ] of event in parts order
+    # returns ( QgsMultiPolyline, error )
+    def segmentsMultiPolyLine(self, segments, start, end, tolerance=0):
         multipolyline = []
         measures = []
-        for part in self.parts:
-            segments = part.eventSegments( start, end )
-            for polyline, measure_from, measure_to in segments:
-                multipolyline.append( polyline )
-                measures.append( [measure_from, measure_to ])
+        for polyline, measure_from, measure_to in segments:
+            multipolyline.append( polyline )
+            measures.append( [measure_from, measure_to ])
         
         error = None
         if len(multipolyline) == 0:
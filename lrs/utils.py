@@ -19,12 +19,19 @@
  *                                                                         *
  ***************************************************************************/
 """
-import sys, math
+import sys, math, bisect
+from itertools import izip
 # Import the PyQt and QGIS libraries
 from PyQt4.QtCore import *
 #from PyQt4.QtGui import *
 from qgis.core import *
 
+try:
+    import numpy
+    haveNumpy = True
+except:
+    haveNumpy = False
+
 # name of plugin in project file
 PROJECT_PLUGIN_NAME = "lrs"
 
@@ -88,17 +95,103 @@ def formatMeasure(measure,measureUnit):
 # return False - not identical
 #        True - identical
 def polylinesIdentical( polyline1, polyline2 ):
+    if len( polyline1 ) != len( polyline2 ):
+        return False
+
     if polyline1 == polyline2: 
         return True
     
-    tmp = []
-    tmp.extend(polyline2)
-    tmp.reverse()
-    return polyline1 == tmp
-
-# return hash of QgsPoint (may be used as key in dictionary)
-def pointHash( point ):
-    return "%s-%s" % ( point.x().__hash__(), point.y().__hash__() )
+    for p1, p2 in izip( polyline1, reversed( polyline2 ) ):
+        if p1 != p2:
+            return False
+    return True
+
+# return direction independent fingerprint of QgsPolyline which may be used as key
+# in dictionary, identical polylines (see polylinesIdentical) have the same 
+# fingerprint, but polylines with the same fingerprint may be different
+def polylineFingerprint( polyline ):
+    start = ( polyline[0].x(), polyline[0].y() )
+    end = ( polyline[-1].x(), polyline[-1].y() )
+    ends = ( start, end ) if start <= end else ( end, start )
+    # sum of coordinates hashes does not depend on direction
+    coorsHash = 0
+    for point in polyline:
+        coorsHash += hash( ( point.x(), point.y() ) )
+    return ( ends, len( polyline ), coorsHash )
+
+# Grid index of points used to find points within given distance.
+# Points are stored with arbitrary (hashable) keys.
+class LrsPointGrid(object):
+
+    def __init__(self, distance):
+        # With cell size twice the search distance all points within distance 
+        # are in neighbouring cells, even if division is rounded
+        self.cellSize = 2.0 * distance
+        self.cells = {} # ( col, row ): { key: QgsPoint }
+
+    def cell(self, point):
+        return ( int( math.floor( point.x() / self.cellSize ) ), int( math.floor( point.y() / self.cellSize ) ) )
+
+    def insert(self, key, point):
+        self.cells.setdefault( self.cell( point ), {} )[key] = point
+
+    def remove(self, key, point):
+        del self.cells[ self.cell( point ) ][key]
+
+    # returns list of ( key, point ) of points from cells around point,
+    # contains all points within distance and possibly some more distant points
+    def neighbours(self, point):
+        col, row = self.cell( point )
+        items = []
+        for c in ( col-1, col, col+1 ):
+            for r in ( row-1, row, row+1 ):
+                cell = self.cells.get( ( c, r ) )
+                if cell:
+                    items.extend( cell.iteritems() )
+        return items
+
+# returns key of QgsPoint usable in dict, keys are equal only for identical points,
+# points within tolerance must be snapped before (see LrsPointGrid), rounding 
+# of coordinates to cells would split close points lying on cell boundary
+def pointKey( point ):
+    return ( point.x(), point.y() )
+
+# returns list of numbers of values in wrong order to each value, i.e. number
+# of greater or equal values before and lower or equal values after the value,
+# counted in O(n log n) using Fenwick (binary indexed) tree of value ranks
+def wrongOrderCounts( values ):
+    ranks = {} # value: rank starting from 1
+    for value in sorted( set( values ) ):
+        ranks[value] = len( ranks ) + 1
+    nRanks = len( ranks )
+
+    # count( tree, i ) = number of values added to tree with rank <= i
+    def add( tree, rank ):
+        while rank <= nRanks:
+            tree[rank] += 1
+            rank += rank & -rank
+
+    def count( tree, rank ):
+        cnt = 0
+        while rank > 0:
+            cnt += tree[rank]
+            rank -= rank & -rank
+        return cnt
+
+    counts = [0] * len( values )
+    tree = [0] * ( nRanks + 1 )
+    for i in range( len(values) ):
+        rank = ranks[ values[i] ]
+        counts[i] += i - count( tree, rank - 1 ) # before and greater or equal
+        add( tree, rank )
+
+    tree = [0] * ( nRanks + 1 )
+    for i in range( len(values)-1, -1, -1 ):
+        rank = ranks[ values[i] ]
+        counts[i] += count( tree, rank ) # after and lower or equal
+        add( tree, rank )
+
+    return counts
 
 def convertDistanceUnits( distance, qgisUnit, lrsUnit ):
     if qgisUnit == QGis.Meters:
@@ -132,16 +225,37 @@ def segmentLength( polyline, segment ):
     p2 = polyline[segment+1]
     return pointsDistance( p1, p2 )
 
+# returns numpy array of polyline coordinates [[x,y],...]
+def polylineCoordinates( polyline ):
+    return numpy.array( [ ( point.x(), point.y() ) for point in polyline ], dtype = numpy.float64 ).reshape( -1, 2 )
+
+# returns list of distances of polyline vertices from polyline beginning
+# coordinates: optional numpy array of polyline coordinates (polylineCoordinates)
+def polylineDistances( polyline, coordinates = None ):
+    if haveNumpy and len(polyline) > 1:
+        if coordinates is None:
+            coordinates = polylineCoordinates( polyline )
+        deltas = numpy.diff( coordinates, axis = 0 )
+        lengths = numpy.sqrt( deltas[:,0] * deltas[:,0] + deltas[:,1] * deltas[:,1] )
+        # cumsum adds sequentially like the loop below so that distances are the same 
+        return [ 0.0 ] + numpy.cumsum( lengths ).tolist()
+
+    distances = [ 0.0 ]
+    length = 0.0
+    for i in range(len(polyline)-1):
+        length += segmentLength( polyline, i )
+        distances.append( length )
+    return distances
+
 # calculate distance along line to pnt
-def measureAlongPolyline( polyline, segment, pnt):
-    measure = 0.0
-    for i in range(segment):
-        measure += segmentLength( polyline, i )
-    
+# distances: optional polyline vertices distances (polylineDistances)
+def measureAlongPolyline( polyline, segment, pnt, distances = None ):
+    if distances is None:
+        distances = polylineDistances( polyline[0:segment+1] )
+    measure = distances[segment]
     measure += pointsDistance( polyline[segment], pnt )
     return measure
 
-
 # delete all features from layer
 #def clearLayer( layer ):
     #if not layer: return
@@ -165,54 +279,79 @@ def pointOnLine( point1, point2, distance ):
     return QgsPoint( x, y )
 
 # returns new QgsPoint on polyline in distance along original polyline
-def polylinePoint( polyline, distance ):
+# distances: optional polyline vertices distances (polylineDistances)
+def polylinePoint( polyline, distance, distances = None ):
     #debug( "polylinePoint distance = %s" % distance )
-    #geo = QgsGeometry.fromPolyline( polyline )
-    #length = geo.length()
-
-    length = 0
-    for i in range(len(polyline)-1):
-        p1 = polyline[i]
-        p2 = polyline[i+1]
-        l = pointsDistance( p1, p2 )
-
-        if distance >= length and distance <= length + l:
-            d = distance - length
-            return pointOnLine ( p1, p2, d )
-        length += l
-    #debug ( 'point in distance %s not found on line length = %s' % ( distance, length ) )
+    if distances is None:
+        distances = polylineDistances( polyline )
+
+    # first segment ending at or after distance
+    i = bisect.bisect_left( distances, distance, 1 ) - 1
+    if i < len(distances)-1 and distance >= distances[i]:
+        d = distance - distances[i]
+        return pointOnLine ( polyline[i], polyline[i+1], d )
+    #debug ( 'point in distance %s not found on line length = %s' % ( distance, distances[-1] ) )
     return None
 
+# returns list of new QgsPoint (or None) on polyline in distances along original polyline
+# distances: optional polyline vertices distances (polylineDistances)
+# coordinates: optional numpy array of polyline coordinates (polylineCoordinates),
+#              if given, points are interpolated at once by numpy
+def polylinePoints( polyline, values, distances = None, coordinates = None ):
+    if distances is None:
+        distances = polylineDistances( polyline )
+    if not haveNumpy or coordinates is None or len(distances) < 2:
+        return [ polylinePoint( polyline, value, distances ) for value in values ]
+
+    values = numpy.array( values, dtype = numpy.float64 )
+    distances = numpy.array( distances, dtype = numpy.float64 )
+    # first segment ending at or after distance, see polylinePoint
+    segments = numpy.searchsorted( distances[1:], values, side = 'left' )
+    valid = segments < len(distances)-1
+    valid[valid] &= values[valid] >= distances[ segments[valid] ]
+    segments = segments[valid]
+
+    p1 = coordinates[segments]
+    deltas = coordinates[segments+1] - p1
+    k = ( values[valid] - distances[segments] ) / numpy.sqrt( deltas[:,0] * deltas[:,0] + deltas[:,1] * deltas[:,1] )
+    xs = ( p1[:,0] + k * deltas[:,0] ).tolist()
+    ys = ( p1[:,1] + k * deltas[:,1] ).tolist()
+
+    points = [ None ] * len(values)
+    j = 0
+    for i in numpy.nonzero( valid )[0].tolist():
+        points[i] = QgsPoint( xs[j], ys[j] )
+        j += 1
+    return points
+
 # returns new polyline 'from - to' measured along original polyline
-def polylineSegment( polyline, frm, to ):
-    geo = QgsGeometry.fromPolyline( polyline )
-    length = geo.length()
+# distances: optional polyline vertices distances (polylineDistances)
+def polylineSegment( polyline, frm, to, distances = None ):
+    if distances is None:
+        distances = polylineDistances( polyline )
 
     poly = [] # section
-    length = 0
-    for i in range(len(polyline)-1):
-        p1 = polyline[i]
-        p2 = polyline[i+1]
-        l = pointsDistance( p1, p2 )
-
-        if len(poly) == 0 and frm <= length + l:
-            d = frm - length
-            p = pointOnLine ( p1, p2, d )
-            poly.append( p )
-
-        if len(poly) > 0:
-            if to < length + l:
-                d = to - length
-                p = pointOnLine ( p1, p2, d )
-                poly.append( p )
-                break
-            else:
-                poly.append( p2 )
-
-        length += l
+    # first segment ending at or after frm
+    i = bisect.bisect_left( distances, frm, 1 ) - 1
+    if i >= len(distances)-1: return poly
+    poly.append( pointOnLine ( polyline[i], polyline[i+1], frm - distances[i] ) )
+
+    # first segment ending after to
+    j = bisect.bisect_right( distances, to, i+1 ) - 1
+    if j < len(distances)-1:
+        poly.extend( polyline[i+1:j+1] )
+        poly.append( pointOnLine ( polyline[j], polyline[j+1], to - distances[j] ) )
+    else:
+        poly.extend( polyline[i+1:] )
 
     return poly
 
+# create geometry from WKB, used to keep geometries compact
+def geometryFromWkb( wkb ):
+    geo = QgsGeometry()
+    geo.fromWkb( wkb )
+    return geo
+
 def getLayerFeature( layer, fid ):
     if not layer: return None
 
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+# Tests of lrs/utils.py, run by python from QGIS installation (qgis.core must
+# be importable), e.g.:
+#   python -m unittest discover -s test
+import os, sys, random, unittest
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..', 'lrs' ) )
+
+from utils import wrongOrderCounts
+
+# Reference: number of milestones in wrong order to each milestone as it was 
+# counted from score matrix in LrsRoutePart.calibrate, score = n - 1 - 2 * wrong,
+# equal measures are considered to be in wrong order
+def wrongOrderCountsReference( values ):
+    counts = []
+    for i in range( len(values) ):
+        wrong = 0
+        for j in range( len(values) ):
+            if i == j: continue
+            if not ( ( i < j and values[i] < values[j] ) or ( i > j and values[i] > values[j] ) ):
+                wrong += 1
+        counts.append( wrong )
+    return counts
+
+class TestWrongOrderCounts(unittest.TestCase):
+
+    def test_examples(self):
+        self.assertEqual( wrongOrderCounts( [] ), [] )
+        self.assertEqual( wrongOrderCounts( [ 1.0 ] ), [ 0 ] )
+        self.assertEqual( wrongOrderCounts( [ 0, 1, 2, 3 ] ), [ 0, 0, 0, 0 ] )
+        self.assertEqual( wrongOrderCounts( [ 3, 0, 4, 5 ] ), [ 1, 1, 0, 0 ] )
+        self.assertEqual( wrongOrderCounts( [ 2, 2 ] ), [ 1, 1 ] )
+        self.assertEqual( wrongOrderCounts( [ None, 1, None ] ), [ 1, 1, 2 ] )
+
+    # compare with reference on random measures including equal values and None
+    def test_random(self):
+        rnd = random.Random( 1 )
+        for t in range(3000):
+            n = rnd.randint( 0, 40 )
+            k = rnd.choice( [ 3, 10, 1000 ] )
+            values = [ rnd.randint( 0, k ) * rnd.choice( [ 1, 0.5 ] ) for i in range(n) ]
+            if rnd.random() < 0.5: 
+                values.sort()
+                # few swaps in almost ordered measures
+                for s in range( rnd.randint( 0, 5 ) ):
+                    if n > 1:
+                        i, j = rnd.randrange(n), rnd.randrange(n)
+                        values[i], values[j] = values[j], values[i]
+            for i in range(n):
+                if rnd.random() < 0.05: values[i] = None
+            self.assertEqual( wrongOrderCounts( values ), wrongOrderCountsReference( values ), values )
+
+if __name__ == '__main__':
+    unittest.main()